@@ -1,20 +1,30 @@
 import os
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from tinydb import TinyDB, Query
-from model import StyleTransferModel
+from model import StyleTransferModel, TransferCancelled
+from jobs import JobManager, Job, BatchScheduler
+from style_cache import StyleFeatureCache
+from fast_style import FastStyleEngine, file_sha256
+from storage import UserStore
+from uploads import BlobStore, UploadTooLarge
+from result_cache import ResultCache
+from progress_hub import ProgressHub
+from derivatives import DerivativePipeline
+import metrics
 import logging
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Optional, List
 import uvicorn
 from pydantic import BaseModel
-import json
 import asyncio
 import traceback
+import hashlib
+import random
+import time
+from email.utils import format_datetime, parsedate_to_datetime
 from PIL import Image
 
 # App setup
@@ -59,94 +69,245 @@ OUTPUT_FOLDER = 'outputs'
 for folder in [UPLOAD_FOLDER, STYLE_FOLDER, OUTPUT_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
+# Uploaded images are stored once per distinct content under uploads/blobs
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+blob_store = BlobStore(os.path.join(UPLOAD_FOLDER, 'blobs'))
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject oversized transfer requests from Content-Length before the body is parsed"""
+    if request.url.path == "/api/transfer":
+        content_length = request.headers.get("content-length")
+        # Two image parts plus a little room for the form fields and multipart framing
+        if content_length and content_length.isdigit() and int(content_length) > 2 * MAX_UPLOAD_BYTES + 64 * 1024:
+            return JSONResponse(status_code=413, content={"detail": "Upload too large"})
+    return await call_next(request)
+
 # Mount static directories
 app.mount("/outputs", StaticFiles(directory=OUTPUT_FOLDER), name="outputs")
 
-# Initialize database
-db = TinyDB('users.json')
-UserQuery = Query()
+# Initialize database (users.json is imported on first start)
+USERS_DB_PATH = os.environ.get("USERS_DB_PATH", "users.db")
+store = UserStore(USERS_DB_PATH, legacy_json_path='users.json')
 
-model = StyleTransferModel()
+# Style Gram cache shared by every transfer; the disk tier survives restarts and is
+# trimmed least-recently-used first to STYLE_CACHE_DISK_MAX_BYTES
+STYLE_CACHE_DIR = os.environ.get("STYLE_CACHE_DIR", os.path.join('cache', 'style_grams'))
+STYLE_CACHE_MAX_BYTES = int(os.environ.get("STYLE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+STYLE_CACHE_DISK_MAX_BYTES = int(os.environ.get("STYLE_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+style_cache = StyleFeatureCache(cache_dir=STYLE_CACHE_DIR, max_bytes=STYLE_CACHE_MAX_BYTES,
+                                max_disk_bytes=STYLE_CACHE_DISK_MAX_BYTES)
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.transfer_status: Dict[str, bool] = {}
-        self.transfer_complete: Dict[str, bool] = {}
+# VGG feature weights come from a local file (export with `python model.py`) and are
+# loaded by the startup warm-up rather than at import; /api/ready reports when they are in
+VGG_WEIGHTS_PATH = os.environ.get("VGG_WEIGHTS_PATH", os.path.join('weights', 'vgg19_features.pt'))
+VGG_ALLOW_DOWNLOAD = os.environ.get("VGG_ALLOW_DOWNLOAD", "1") != "0"
+model = StyleTransferModel(style_cache=style_cache, weights_path=VGG_WEIGHTS_PATH,
+                           allow_download=VGG_ALLOW_DOWNLOAD, lazy=True)
+model_ready = False
+model_load_error = None
 
-    async def connect(self, websocket: WebSocket, client_id: str):
-        try:
-            await websocket.accept()
-            self.active_connections[client_id] = websocket
-            self.transfer_status[client_id] = False
-            self.transfer_complete[client_id] = False
-            logger.info(f"WebSocket connection established for client {client_id}. Active connections: {len(self.active_connections)}")
-            return True
-        except Exception as e:
-            logger.error(f"Error establishing WebSocket connection for client {client_id}: {str(e)}")
-            return False
+# Opt-in CPU execution modes; compare them with `python compare_modes.py` first
+model.configure(
+    channels_last=os.environ.get("TORCH_CHANNELS_LAST", "0") == "1",
+    bf16=os.environ.get("TORCH_BF16", "0") == "1",
+    compile=os.environ.get("TORCH_COMPILE", "0") == "1",
+    num_threads=int(os.environ["TORCH_THREADS"]) if os.environ.get("TORCH_THREADS") else None
+)
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-            if client_id in self.transfer_status:
-                del self.transfer_status[client_id]
-            if client_id in self.transfer_complete:
-                del self.transfer_complete[client_id]
-            logger.info(f"WebSocket connection closed for client {client_id}. Active connections: {len(self.active_connections)}")
-
-    async def send_progress(self, client_id: str, progress: dict):
-        if client_id in self.active_connections:
-            try:
-                await self.active_connections[client_id].send_json(progress)
-                if progress.get('completed', False):
-                    self.transfer_complete[client_id] = True
-                    logger.info(f"Transfer marked as complete for client {client_id}")
-            except Exception as e:
-                logger.error(f"Error sending progress to client {client_id}: {str(e)}")
-                self.disconnect(client_id)
-
-manager = ConnectionManager()
-
-# WebSocket endpoint for progress updates
-@app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    logger.info(f"Attempting to establish WebSocket connection for client {client_id}")
-    connected = await manager.connect(websocket, client_id)
-    if not connected:
-        return
+# Progress updates go out every PROGRESS_EVERY_STEPS steps or PROGRESS_EVERY_SECONDS,
+# whichever comes first, instead of on every optimisation step
+model.progress_every_steps = int(os.environ.get("PROGRESS_EVERY_STEPS", 25))
+model.progress_every_seconds = float(os.environ.get("PROGRESS_EVERY_SECONDS", 1.0))
+
+# Optional live previews: small PREVIEW_FORMAT frames of at most PREVIEW_SIZE pixels,
+# sent as binary websocket messages every PREVIEW_EVERY_STEPS steps or PREVIEW_EVERY_SECONDS
+model.preview_every_steps = int(os.environ.get("PREVIEW_EVERY_STEPS", 50))
+model.preview_every_seconds = float(os.environ.get("PREVIEW_EVERY_SECONDS", 2.0))
+model.preview_size = int(os.environ.get("PREVIEW_SIZE", 128))
+model.preview_format = os.environ.get("PREVIEW_FORMAT", "JPEG").upper()
+
+# Finished results keyed by input hashes and parameters, so resubmissions are free
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join('cache', 'results'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+result_cache = ResultCache(cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES)
+
+# Trained feed-forward networks (see fast_style.py) for styles that have one
+FAST_MODELS_DIR = os.environ.get("FAST_MODELS_DIR", "fast_models")
+fast_engine = FastStyleEngine(model, models_dir=FAST_MODELS_DIR)
+
+# Background workers that run style transfer jobs off the event loop
+TRANSFER_WORKERS = int(os.environ.get("TRANSFER_WORKERS", 2))
+job_manager = JobManager(max_workers=TRANSFER_WORKERS)
+
+# Concurrent Adam jobs with the same working shape are stacked into one batch
+TRANSFER_MAX_BATCH = int(os.environ.get("TRANSFER_MAX_BATCH", 4))
+TRANSFER_BATCH_WINDOW = float(os.environ.get("TRANSFER_BATCH_WINDOW", 0.2))
+
+# Optimisation defaults: the step count is a ceiling, and the run stops early once
+# the relative loss improvement over TRANSFER_WINDOW steps drops below the tolerance
+TRANSFER_STEPS = int(os.environ.get("TRANSFER_STEPS", 500))
+TRANSFER_OPTIMIZER = os.environ.get("TRANSFER_OPTIMIZER", "adam")
+TRANSFER_TOLERANCE = float(os.environ.get("TRANSFER_TOLERANCE", 1e-3))
+TRANSFER_WINDOW = int(os.environ.get("TRANSFER_WINDOW", 50))
+
+# Optional wall-clock budget per job in seconds, counted from when it starts running;
+# at the deadline the optimisation stops and the image so far is the result. Requests
+# may ask for a shorter time_budget. 0 means no limit.
+TRANSFER_TIME_BUDGET = float(os.environ.get("TRANSFER_TIME_BUDGET", 0))
+
+# Unfinished jobs are cancelled once nobody has followed their progress for
+# CANCEL_GRACE_SECONDS after a websocket disconnect; a negative value turns this off
+CANCEL_GRACE_SECONDS = float(os.environ.get("CANCEL_GRACE_SECONDS", 30))
+
+# Per-phase timings and job counters are served on /metrics; this fraction of jobs
+# also keeps its per-phase totals in the stored image record as 'trace'
+METRICS_TRACE_SAMPLE_RATE = float(os.environ.get("METRICS_TRACE_SAMPLE_RATE", 0.0))
+JOBS_TOTAL = metrics.REGISTRY.register(metrics.Counter(
+    'style_transfer_jobs_total', 'Finished style transfer jobs', ['status', 'engine']))
+JOB_SECONDS = metrics.REGISTRY.register(metrics.Histogram(
+    'style_transfer_job_seconds', 'Time from submission to result of style transfer jobs', ['engine']))
+
+def parse_int_list(value: Optional[str]) -> Optional[List[int]]:
+    """Parse a comma separated list of integers such as "128,256,512"."""
+    if not value:
+        return None
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def parse_style_blend(value: Optional[str]) -> List[tuple]:
+    """Parse stock styles to blend, such as "style_1.jpg:0.7,style_3.jpeg:0.3" (weights default to 1)."""
+    if not value:
+        return []
+    blend = []
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, _, weight = item.strip().partition(':')
+        blend.append((name, float(weight) if weight else 1.0))
+    return blend
+
+# Coarse-to-fine pyramid mode, e.g. TRANSFER_PYRAMID_LEVELS="128,256,512" and
+# TRANSFER_PYRAMID_STEPS="300,50,20"; unset means a single 128px level
+TRANSFER_PYRAMID_LEVELS = parse_int_list(os.environ.get("TRANSFER_PYRAMID_LEVELS"))
+TRANSFER_PYRAMID_STEPS = parse_int_list(os.environ.get("TRANSFER_PYRAMID_STEPS"))
+# Each pyramid level is optimised as one whole image, not in tiles, so its activations
+# grow with the square of its size; levels above this need the tiled resolution mode
+TRANSFER_MAX_PYRAMID_RESOLUTION = int(os.environ.get("TRANSFER_MAX_PYRAMID_RESOLUTION", 1024))
+
+# High-resolution output: a request with a resolution (shorter edge, up to
+# TRANSFER_MAX_RESOLUTION) is optimised in overlapping tiles, TRANSFER_TILE_WORKERS at a time
+TRANSFER_MAX_RESOLUTION = int(os.environ.get("TRANSFER_MAX_RESOLUTION", 4096))
+TRANSFER_TILE_SIZE = int(os.environ.get("TRANSFER_TILE_SIZE", 256))
+TRANSFER_TILE_OVERLAP = int(os.environ.get("TRANSFER_TILE_OVERLAP", 32))
+TRANSFER_TILE_WORKERS = int(os.environ.get("TRANSFER_TILE_WORKERS", 2))
+
+# Resized copies of every result (longer edge in pixels, e.g. DERIVATIVE_SIZES="200,400,800"),
+# encoded in a process pool in each of DERIVATIVE_FORMATS that Pillow supports
+DERIVATIVE_SIZES = parse_int_list(os.environ.get("DERIVATIVE_SIZES")) or [200, 400, 800]
+DERIVATIVE_FORMATS = [name.strip().lower() for name in os.environ.get("DERIVATIVE_FORMATS", "avif,webp,jpeg").split(",")]
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", 2))
+THUMBNAIL_WIDTH = int(os.environ.get("THUMBNAIL_WIDTH", 200))
+derivative_pipeline = DerivativePipeline(sizes=DERIVATIVE_SIZES, formats=DERIVATIVE_FORMATS,
+                                         max_workers=DERIVATIVE_WORKERS)
 
+# Progress pub/sub: any number of websockets can follow a client id or a job id, and
+# reconnecting clients get the last PROGRESS_HISTORY messages replayed
+PROGRESS_HISTORY = int(os.environ.get("PROGRESS_HISTORY", 16))
+PROGRESS_IDLE_TIMEOUT = float(os.environ.get("PROGRESS_IDLE_TIMEOUT", 600))
+progress_hub = ProgressHub(history_size=PROGRESS_HISTORY, idle_timeout=PROGRESS_IDLE_TIMEOUT)
+
+async def stream_progress(websocket: WebSocket, channel_id: str):
+    """Subscribe a websocket to a progress channel until it disconnects."""
+    await websocket.accept()
+    subscription = progress_hub.subscribe(channel_id)
+    logger.info(f"WebSocket subscribed to {channel_id}. Active connections: {progress_hub.subscriber_count()}")
+
+    async def forward():
+        while True:
+            message = await subscription.get()
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
+            else:
+                await websocket.send_json(message)
+
+    sender = asyncio.create_task(forward())
+    receiver = asyncio.create_task(websocket.receive_text())
     try:
         while True:
-            try:
-                data = await websocket.receive_text()
-                logger.debug(f"Received message from client {client_id}: {data}")
-            except WebSocketDisconnect:
-                logger.info(f"WebSocket disconnected normally for client {client_id}")
-                break
-            except Exception as e:
-                logger.error(f"WebSocket error for client {client_id}: {str(e)}")
-                break
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done:
+                # Sending failed, so the socket is gone
+                sender.result()
+            data = receiver.result()
+            logger.debug(f"Received message on {channel_id}: {data}")
+            receiver = asyncio.create_task(websocket.receive_text())
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket disconnected normally from {channel_id}")
+    except Exception as e:
+        logger.error(f"WebSocket error on {channel_id}: {str(e)}")
     finally:
-        # Only disconnect if the transfer is complete
-        if client_id in manager.transfer_complete and manager.transfer_complete[client_id]:
-            logger.info(f"Transfer completed, closing WebSocket for client {client_id}")
-            manager.disconnect(client_id)
-        else:
-            logger.warning(f"WebSocket disconnected before transfer completion for client {client_id}")
+        sender.cancel()
+        receiver.cancel()
+        progress_hub.unsubscribe(subscription)
+        logger.info(f"WebSocket unsubscribed from {channel_id}. Active connections: {progress_hub.subscriber_count()}")
+        if CANCEL_GRACE_SECONDS >= 0 and progress_hub.subscriber_count(channel_id) == 0:
+            asyncio.create_task(cancel_abandoned_jobs(channel_id, datetime.now().isoformat()))
+
+async def cancel_abandoned_jobs(channel_id: str, disconnected_at: str):
+    """Cancel jobs submitted before a disconnect if no websocket follows them after the grace period."""
+    await asyncio.sleep(CANCEL_GRACE_SECONDS)
+    for job in job_manager.unfinished():
+        if job.created_at > disconnected_at:
+            continue
+        channels = [job.params.get('client_id'), f'job:{job.id}']
+        if channel_id not in channels or any(progress_hub.subscriber_count(channel) for channel in channels):
+            continue
+        logger.info(f"Cancelling job {job.id}: no progress subscribers for {CANCEL_GRACE_SECONDS}s")
+        if job_manager.cancel(job) == Job.PENDING:
+            # It never started, so nothing else will report it
+            record_cancelled_job(job)
+
+# WebSocket endpoints for progress updates
+@app.websocket("/ws/{client_id}")
+async def websocket_endpoint(websocket: WebSocket, client_id: str):
+    await stream_progress(websocket, client_id)
+
+@app.websocket("/ws/jobs/{job_id}")
+async def job_websocket_endpoint(websocket: WebSocket, job_id: str):
+    await stream_progress(websocket, f'job:{job_id}')
+
+def publish_progress(job, request, message: dict):
+    """Thread-safe: publish to the submitting client and to the job's own channel."""
+    progress_hub.publish([request['client_id'], f'job:{job.id}'], {**message, 'job_id': job.id})
 
-def progress_callback(current, total, loss, client_id):
+def publish_frame(job, request, frame: bytes):
+    """Thread-safe: publish an encoded preview frame as a binary websocket message."""
+    progress_hub.publish([request['client_id'], f'job:{job.id}'], frame)
+
+def record_cancelled_job(job):
+    """Tell subscribers a job was cancelled and count it."""
+    logger.info(f"Style transfer job {job.id} cancelled")
+    progress_hub.publish([job.params['client_id'], f'job:{job.id}'], {'cancelled': True, 'job_id': job.id})
+    JOBS_TOTAL.inc(status='cancelled', engine='fast' if job.params.get('fast_style') else 'optimize')
+
+def progress_callback(current, total, loss, job, request):
     progress = {
         'current': current,
         'total': total,
         'loss': loss,
         'percentage': (current / total) * 100
     }
-    # We'll handle this asynchronously in the WebSocket endpoint
-    asyncio.create_task(manager.send_progress(client_id, progress))
+    job.progress = progress
+    publish_progress(job, request, progress)
     return progress
 
+async def cleanup_progress_channels():
+    while True:
+        await asyncio.sleep(60)
+        removed = progress_hub.cleanup()
+        if removed:
+            logger.info(f"Dropped {removed} idle progress channel(s)")
+
 # Pydantic models for request validation
 class UserRegister(BaseModel):
     name: str
@@ -173,59 +334,30 @@ class ImageMetadata(BaseModel):
 
 # Helper functions for image management
 def create_user_image_directories(email: str):
-    """Create user-specific directories for images"""
-    user_uploads = os.path.join(UPLOAD_FOLDER, email)
+    """Create user-specific directories for images (uploads live in the shared blob store)"""
     user_outputs = os.path.join(OUTPUT_FOLDER, email)
     user_thumbnails = os.path.join(OUTPUT_FOLDER, email, 'thumbnails')
     
-    for directory in [user_uploads, user_outputs, user_thumbnails]:
+    for directory in [user_outputs, user_thumbnails]:
         os.makedirs(directory, exist_ok=True)
     
-    return user_uploads, user_outputs, user_thumbnails
+    return user_outputs, user_thumbnails
 
-def create_thumbnail(image_path: str, thumbnail_path: str, size: tuple = (200, 200)):
-    """Create a thumbnail version of the image"""
-    try:
-        with Image.open(image_path) as img:
-            img.thumbnail(size)
-            img.save(thumbnail_path, quality=85, optimize=True)
-        return True
-    except Exception as e:
-        logger.error(f"Error creating thumbnail: {str(e)}")
-        return False
-
-def get_image_metadata(image_path: str) -> dict:
-    """Get metadata for an image"""
-    try:
-        with Image.open(image_path) as img:
-            return {
-                'size': os.path.getsize(image_path),
-                'dimensions': {
-                    'width': img.width,
-                    'height': img.height
-                }
-            }
-    except Exception as e:
-        logger.error(f"Error getting image metadata: {str(e)}")
-        return {
-            'size': 0,
-            'dimensions': {'width': 0, 'height': 0}
-        }
+def record_derivatives(email: str, filename: str, derivatives: List[dict]):
+    """Attach finished derivatives to an image record; the default thumbnail is a JPEG."""
+    for derivative in derivatives:
+        derivative['path'] = f'/outputs/{email}/thumbnails/{derivative.pop("file")}'
+    thumbnail = DerivativePipeline.pick(derivatives, THUMBNAIL_WIDTH)
+    fields = {'derivatives': derivatives}
+    if thumbnail:
+        fields['thumbnail_path'] = thumbnail['path']
+    store.update_image(email, filename, fields)
 
 @app.post("/api/register")
 async def register_user(user: UserRegister):
     try:
         logger.info(f"Received registration request for: {user.email}")
         
-        # Load existing users
-        users_data = load_users()
-        
-        # Check if user already exists
-        for existing_user in users_data["users"]:
-            if existing_user["email"] == user.email:
-                logger.warning(f"Attempt to register existing email: {user.email}")
-                raise HTTPException(status_code=400, detail="Email already registered")
-        
         # Create new user record
         new_user = {
             'name': user.name,
@@ -237,21 +369,22 @@ async def register_user(user: UserRegister):
             'transformed_images': []
         }
         
-        # Add new user to the list
-        users_data["users"].append(new_user)
-        
-        # Save updated users data
-        save_users(users_data)
+        # Insert unless the email is already registered
+        if not store.create_user(new_user):
+            logger.warning(f"Attempt to register existing email: {user.email}")
+            raise HTTPException(status_code=400, detail="Email already registered")
         
         logger.info(f"User registered successfully: {user.email}")
         return {"message": "User registered successfully", "user": new_user}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Registration error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/check-user/{email}")
 async def check_user(email: str):
-    exists = bool(db.get(UserQuery.email == email))
+    exists = store.user_exists(email)
     return {"exists": exists}
 
 @app.post("/api/login")
@@ -259,7 +392,7 @@ async def login_user(user: UserLogin):
     try:
         logger.info(f"Received login request for: {user.email}")
         
-        db_user = db.get(UserQuery.email == user.email)
+        db_user = store.get_user(user.email)
         
         if not db_user:
             # Create new user record if not exists
@@ -271,7 +404,7 @@ async def login_user(user: UserLogin):
                 'last_login': datetime.now().isoformat(),
                 'images': []
             }
-            db.insert(user_data)
+            store.create_user(user_data)
             logger.info(f"New user logged in: {user.email}")
             return {
                 "success": True,
@@ -280,9 +413,9 @@ async def login_user(user: UserLogin):
             }
         
         # Update last login time
-        db.update({
+        store.update_user(user.email, {
             'last_login': datetime.now().isoformat()
-        }, UserQuery.email == user.email)
+        })
         
         logger.info(f"User logged in: {user.email}")
         return {
@@ -290,78 +423,117 @@ async def login_user(user: UserLogin):
             "message": f"Welcome {db_user.get('name', 'User')}!",
             "user": db_user
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/gallery/{email}")
-async def get_gallery(email: str, page: int = 1, per_page: int = 20):
-    """Get user's image gallery with pagination"""
+async def get_gallery(request: Request, email: str, page: int = 1, per_page: int = 20,
+                      cursor: Optional[str] = None, thumb_width: int = THUMBNAIL_WIDTH):
+    """Get user's image gallery with pagination
+
+    Pass the returned next_cursor as cursor for keyset pagination. Responses carry
+    an ETag and Last-Modified, and unchanged pages come back as 304. Each thumbnail_path
+    is the smallest derivative at least thumb_width wide in a format the client accepts.
+    """
     try:
-        users_data = load_users()
-        user = next((u for u in users_data["users"] if u["email"] == email), None)
-        
-        if not user:
+        version = store.gallery_version(email)
+        if version is None:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Use transformed_images instead of images
-        images = user.get("transformed_images", [])
-        total_images = len(images)
+        # Validators change whenever an image is added, deleted or retagged
+        gallery_version, updated_at = version
+        accept = request.headers.get("accept", "")
+        accepted_formats = ",".join(name for name in derivative_pipeline.formats if name in accept)
+        etag_source = f"{email}:{gallery_version}:{page}:{per_page}:{cursor or ''}:{thumb_width}:{accepted_formats}"
+        headers = {
+            "ETag": f'W/"{hashlib.sha1(etag_source.encode()).hexdigest()}"',
+            "Cache-Control": "no-cache",
+            "Vary": "Accept"
+        }
+        if updated_at:
+            headers["Last-Modified"] = format_datetime(datetime.fromisoformat(updated_at), usegmt=True)
+        if is_not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
         
-        # Calculate pagination
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
+        total_images = store.count_images(email)
         
-        # Sort images by timestamp (newest first)
-        sorted_images = sorted(images, key=lambda x: x.get("transformed_at", x.get("timestamp", "")), reverse=True)
-        paginated_images = sorted_images[start_idx:end_idx]
+        # Newest first, read straight off the (email, transformed_at, id) index
+        try:
+            paginated_images, next_cursor = store.page_images(
+                email, per_page, cursor=cursor, offset=(page - 1) * per_page)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        return {
+        for image in paginated_images:
+            thumbnail = DerivativePipeline.pick(image.get('derivatives') or [], thumb_width, accept)
+            if thumbnail:
+                image['thumbnail_path'] = thumbnail['path']
+        
+        return JSONResponse(headers=headers, content={
             "images": paginated_images,
             "pagination": {
                 "current_page": page,
                 "per_page": per_page,
                 "total_images": total_images,
-                "total_pages": (total_images + per_page - 1) // per_page
+                "total_pages": (total_images + per_page - 1) // per_page,
+                "next_cursor": next_cursor
             }
-        }
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error fetching gallery: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def is_not_modified(request: Request, headers: dict) -> bool:
+    """Evaluate If-None-Match / If-Modified-Since against the response validators"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or headers["ETag"] in tags or headers["ETag"][2:] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in headers:
+        try:
+            return parsedate_to_datetime(headers["Last-Modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
 @app.delete("/api/images/{email}/{filename}")
 async def delete_image(email: str, filename: str):
     """Delete an image from user's gallery"""
     try:
-        users_data = load_users()
-        user = next((u for u in users_data["users"] if u["email"] == email), None)
-        
-        if not user:
+        if not store.user_exists(email):
             raise HTTPException(status_code=404, detail="User not found")
         
         # Find the image in user's gallery
-        image = next((img for img in user.get("transformed_images", []) if img["filename"] == filename), None)
+        image = store.get_image(email, filename)
         if not image:
             raise HTTPException(status_code=404, detail="Image not found")
         
-        # Delete the image files
-        image_path = os.path.join(OUTPUT_FOLDER, email, filename)
-        thumbnail_path = os.path.join(OUTPUT_FOLDER, email, 'thumbnails', f'thumb_{filename}')
+        # Delete the image files, including legacy thumbnails and derivatives
+        thumbnails_dir = os.path.join(OUTPUT_FOLDER, email, 'thumbnails')
+        paths = [os.path.join(OUTPUT_FOLDER, email, filename), os.path.join(thumbnails_dir, f'thumb_{filename}')]
+        paths += [os.path.join(thumbnails_dir, os.path.basename(derivative['path']))
+                  for derivative in image.get('derivatives') or []]
         
         try:
-            if os.path.exists(image_path):
-                os.remove(image_path)
-            if os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
         except Exception as e:
             logger.error(f"Error deleting image files: {str(e)}")
             raise HTTPException(status_code=500, detail="Failed to delete image files")
         
         # Remove image from user's gallery
-        user["transformed_images"] = [img for img in user["transformed_images"] if img["filename"] != filename]
-        save_users(users_data)
+        store.delete_image(email, filename)
         
         return {"message": "Image deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error deleting image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -370,22 +542,16 @@ async def delete_image(email: str, filename: str):
 async def update_image_tags(email: str, filename: str, tags: List[str]):
     """Update tags for an image"""
     try:
-        users_data = load_users()
-        user = next((u for u in users_data["users"] if u["email"] == email), None)
-        
-        if not user:
+        if not store.user_exists(email):
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Find the image in user's gallery
-        image = next((img for img in user.get("images", []) if img["filename"] == filename), None)
-        if not image:
+        # Update tags on the image in user's gallery
+        if not store.update_image(email, filename, {"tags": tags}):
             raise HTTPException(status_code=404, detail="Image not found")
         
-        # Update tags
-        image["tags"] = tags
-        save_users(users_data)
-        
         return {"message": "Tags updated successfully", "tags": tags}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error updating image tags: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -393,109 +559,531 @@ async def update_image_tags(email: str, filename: str, tags: List[str]):
 @app.post("/api/transfer")
 async def transfer_style(
     content: UploadFile = File(...),
-    style: UploadFile = File(...),
+    style: Optional[UploadFile] = File(None),
     email: str = Form(...),
-    client_id: str = Form(...)
+    client_id: str = Form(...),
+    optimizer: Optional[str] = Form(None),
+    levels: Optional[str] = Form(None),
+    level_steps: Optional[str] = Form(None),
+    engine: str = Form("auto"),
+    preview: bool = Form(False),
+    resolution: Optional[int] = Form(None),
+    styles: Optional[str] = Form(None),
+    style_weight: float = Form(1.0),
+    time_budget: Optional[float] = Form(None)
 ):
     try:
         logger.info(f"Starting style transfer process for user: {email}")
         
+        optimizer = optimizer or TRANSFER_OPTIMIZER
+        if optimizer not in StyleTransferModel.OPTIMIZERS:
+            raise HTTPException(status_code=400, detail=f"Optimizer must be one of {', '.join(StyleTransferModel.OPTIMIZERS)}")
+        if engine not in ("auto", "optimize"):
+            raise HTTPException(status_code=400, detail="Engine must be 'auto' or 'optimize'")
+        try:
+            pyramid = {
+                'levels': parse_int_list(levels) or TRANSFER_PYRAMID_LEVELS,
+                'level_steps': parse_int_list(level_steps) or TRANSFER_PYRAMID_STEPS
+            }
+        except ValueError:
+            raise HTTPException(status_code=400, detail="levels and level_steps must be comma separated integers")
+        if pyramid['levels'] is None:
+            pyramid['level_steps'] = None
+        elif pyramid['level_steps'] is not None and len(pyramid['level_steps']) != len(pyramid['levels']):
+            raise HTTPException(status_code=400, detail="levels and level_steps must have the same length")
+        if pyramid['levels']:
+            if not all(0 < size <= TRANSFER_MAX_PYRAMID_RESOLUTION for size in pyramid['levels']):
+                raise HTTPException(status_code=400,
+                                    detail=f"levels must be between 1 and {TRANSFER_MAX_PYRAMID_RESOLUTION}")
+            if any(later <= earlier for earlier, later in zip(pyramid['levels'], pyramid['levels'][1:])):
+                raise HTTPException(status_code=400, detail="levels must be increasing")
+        if pyramid['level_steps']:
+            # The levels together get no more steps than a single-level transfer
+            if any(steps <= 0 for steps in pyramid['level_steps']) or sum(pyramid['level_steps']) > TRANSFER_STEPS:
+                raise HTTPException(status_code=400,
+                                    detail=f"level_steps must be positive and add up to at most {TRANSFER_STEPS}")
+        tiled = None
+        if resolution is not None:
+            if not 0 < resolution <= TRANSFER_MAX_RESOLUTION:
+                raise HTTPException(status_code=400, detail=f"Resolution must be between 1 and {TRANSFER_MAX_RESOLUTION}")
+            if pyramid['levels']:
+                raise HTTPException(status_code=400, detail="resolution cannot be combined with levels")
+            tiled = {'size': resolution, 'tile_size': TRANSFER_TILE_SIZE, 'overlap': TRANSFER_TILE_OVERLAP}
+        try:
+            blend = parse_style_blend(styles)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="styles must look like 'style_1.jpg:0.7,style_3.jpeg:0.3'")
+        stock_styles = [f for f in os.listdir(STYLE_FOLDER) if f.endswith(('.png', '.jpg', '.jpeg'))]
+        for name, _ in blend:
+            if name not in stock_styles:
+                raise HTTPException(status_code=400, detail=f"Unknown style: {name}")
+        if time_budget is not None and time_budget <= 0:
+            raise HTTPException(status_code=400, detail="time_budget must be a positive number of seconds")
+        # The stricter of the request's and the server's budget applies
+        budgets = [budget for budget in (time_budget, TRANSFER_TIME_BUDGET) if budget]
+        time_budget = min(budgets) if budgets else None
+        if style is None and not blend:
+            raise HTTPException(status_code=400, detail="Upload a style image or choose styles to blend")
+        weights = [weight for _, weight in blend] + ([style_weight] if style is not None else [])
+        if any(weight < 0 for weight in weights) or sum(weights) <= 0:
+            raise HTTPException(status_code=400, detail="Style weights must be non-negative and add up to more than zero")
+        
         # Create user-specific directories
-        user_uploads, user_outputs, user_thumbnails = create_user_image_directories(email)
+        user_outputs, user_thumbnails = create_user_image_directories(email)
         
         # Validate file types
         if not content.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="Content file must be an image")
-        if not style.content_type.startswith('image/'):
+        if style is not None and not style.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="Style file must be an image")
 
-        # Create secure filenames with timestamps
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        content_filename = secure_filename(f"content_{timestamp}_{content.filename}")
-        style_filename = secure_filename(f"style_{timestamp}_{style.filename}")
-        
-        content_path = os.path.join(user_uploads, content_filename)
-        style_path = os.path.join(user_uploads, style_filename)
+        # Timestamp for the result filename (microseconds keep concurrent results apart)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         
-        # Save uploaded files
+        # Save uploaded files into the content-addressed blob store, hashing in chunks
+        # off the event loop; bytes that are already stored are not written again
         try:
-            content_data = await content.read()
-            style_data = await style.read()
-            
-            with open(content_path, 'wb') as f:
-                f.write(content_data)
-            with open(style_path, 'wb') as f:
-                f.write(style_data)
+            with metrics.phase('upload_save'):
+                content_sha256, content_path, content_size, _ = await asyncio.to_thread(
+                    blob_store.store_stream, content.file, MAX_UPLOAD_BYTES)
+            if style is not None:
+                with metrics.phase('upload_save'):
+                    style_sha256, style_path, style_size, _ = await asyncio.to_thread(
+                        blob_store.store_stream, style.file, MAX_UPLOAD_BYTES)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
         except Exception as e:
             logger.error(f"Error saving uploaded files: {str(e)}")
             raise HTTPException(status_code=500, detail="Failed to save uploaded files")
+        store.add_upload(email, content_sha256, 'content', content.filename, content_size)
+        
+        # Styles as (path, sha256, name, weight); stock styles are read in place and
+        # their Grams were precomputed at startup, so blending them adds no feature passes
+        style_parts = []
+        if style is not None:
+            store.add_upload(email, style_sha256, 'style', style.filename, style_size)
+            style_parts.append((style_path, style_sha256, style.filename, style_weight))
+        for name, weight in blend:
+            path = os.path.join(STYLE_FOLDER, name)
+            style_parts.append((path, await asyncio.to_thread(file_sha256, path), name, weight))
+        if len(style_parts) == 1:
+            style_path, style_sha256, style_filename, _ = style_parts[0]
+        else:
+            # Weights are normalised so equivalent mixes share a result cache entry
+            total = sum(weight for *_, weight in style_parts)
+            style_path = [(path, weight) for path, _, _, weight in style_parts]
+            style_sha256 = [(sha256, round(weight / total, 6)) for _, sha256, _, weight in style_parts]
+            style_filename = ' + '.join(f'{name} ({weight / total:.0%})' for _, _, name, weight in style_parts)
 
-        try:
-            # Set the progress callback
-            model.set_progress_callback(lambda current, total, loss: progress_callback(current, total, loss, client_id))
-            
-            # Perform style transfer
-            output_image = model.transfer_style(content_path, style_path)
-            
-            # Generate output filename
-            output_filename = f'result_{timestamp}_{os.path.splitext(content.filename)[0]}.jpg'
-            output_path = os.path.join(user_outputs, output_filename)
-            
-            # Save the output image
-            output_image.save(output_path)
-            
-            # Create thumbnail
-            thumbnail_filename = f'thumb_{output_filename}'
-            thumbnail_path = os.path.join(user_thumbnails, thumbnail_filename)
-            create_thumbnail(output_path, thumbnail_path)
-            
-            # Get image metadata
-            metadata = get_image_metadata(output_path)
-            
-            # Prepare image record
-            image_record = {
-                'filename': output_filename,
-                'original_filename': content.filename,
-                'path': f'/outputs/{email}/{output_filename}',
-                'thumbnail_path': f'/outputs/{email}/thumbnails/{thumbnail_filename}',
-                'transformed_at': datetime.now().isoformat(),
-                'style_used': style.filename,
-                'is_original': False,
-                'size': metadata['size'],
-                'dimensions': metadata['dimensions'],
-                'tags': []
-            }
-            
-            # Update user's image history
-            users_data = load_users()
-            for user in users_data["users"]:
-                if user["email"] == email:
-                    if "transformed_images" not in user:
-                        user["transformed_images"] = []
-                    user["transformed_images"].append(image_record)
-                    break
-            save_users(users_data)
-            
-            # Send final progress update
-            await manager.send_progress(client_id, {
-                'current': 100,
-                'total': 100,
-                'loss': 0,
-                'percentage': 100,
-                'completed': True,
-                'image_data': image_record
-            })
-            
-            return image_record
-            
-        except Exception as e:
-            logger.error(f"Error during style transfer: {str(e)}")
-            raise HTTPException(status_code=500, detail=str(e))
+        request = {
+            'content_path': content_path,
+            'style_path': style_path,
+            'content_sha256': content_sha256,
+            'style_sha256': style_sha256,
+            'email': email,
+            'client_id': client_id,
+            'content_filename': content.filename,
+            'style_filename': style_filename,
+            'timestamp': timestamp,
+            'optimizer': optimizer,
+            'pyramid': pyramid,
+            'tiled': tiled,
+            'engine': engine,
+            'preview': preview,
+            'submitted_at': time.monotonic(),
+            'trace': random.random() < METRICS_TRACE_SAMPLE_RATE,
+            'time_budget': time_budget,
+            # Use a trained feed-forward network when one exists for this style
+            'fast_style': (style_sha256 if engine == "auto" and len(style_parts) == 1
+                           and fast_engine.has_style(style_sha256) else None)
+        }
+        request['cache_key'] = transfer_cache_key(request)
+        job_params = {'client_id': client_id, 'optimizer': optimizer, 'engine': engine, 'resolution': resolution,
+                      'styles': styles, 'time_budget': time_budget, 'fast_style': bool(request['fast_style']),
+                      **pyramid}
+        
+        cached = result_cache.get(request['cache_key'])
+        if cached:
+            # Identical transfer already computed: copy it into the gallery right away
+            logger.info(f"Result cache hit for user: {email}")
+            job = await asyncio.to_thread(job_manager.run_now, run_cached_transfer_job, request, cached,
+                                          owner=email, params=job_params)
+        else:
+            # Hand the optimisation over to the worker pool and return immediately
+            job = transfer_scheduler.submit(transfer_batch_key(request), request,
+                                            owner=email, params=job_params)
+        
+        return JSONResponse(status_code=202, content={
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/api/jobs/{job.id}',
+            'progress_url': f'/ws/jobs/{job.id}',
+            'result_url': f'/api/jobs/{job.id}/result'
+        })
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Style transfer error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def transfer_cache_key(request):
+    """Everything that determines a transfer's output, hashed into a result cache key."""
+    return result_cache.make_key(
+        content=request['content_sha256'],
+        style=request['style_sha256'],
+        engine='fast' if request['fast_style'] else 'optimize',
+        optimizer=request['optimizer'],
+        num_steps=TRANSFER_STEPS,
+        tolerance=TRANSFER_TOLERANCE,
+        window=TRANSFER_WINDOW,
+        pyramid=request['pyramid'],
+        tiled=request['tiled'],
+        image_size=model.image_size,
+        content_weight=model.content_weight,
+        style_weight=model.style_weight,
+        style_weights=model.style_weights,
+        features=StyleFeatureCache.KEY_VERSION
+    )
+
+def transfer_batch_key(request):
+    """Jobs with equal keys can be optimised together; None means the job runs alone."""
+    # Previews are only streamed from single transfers
+    if (request['fast_style'] or request['optimizer'] != 'adam' or request['pyramid']['levels']
+            or request['tiled'] or request['preview']):
+        return None
+    try:
+        # Jobs in a batch share one deadline, so only equal budgets batch together
+        with Image.open(request['content_path']) as img:
+            return ('adam', model.working_shape(img.size), request['time_budget'])
+    except Exception:
+        return None
+
+def job_progress_callback(job, request):
+    return lambda current, total, loss: progress_callback(current, total, loss, job, request)
+
+def job_preview_callback(job, request):
+    if not request['preview']:
+        return None
+    return lambda step, frame: publish_frame(job, request, frame)
+
+def run_transfer_job(job, request):
+    """Run a queued style transfer on a worker thread and record the result."""
+    if request['trace']:
+        metrics.start_trace()
+    try:
+        if request['fast_style']:
+            levels = request['pyramid']['levels']
+            size = request['tiled']['size'] if request['tiled'] else (levels[-1] if levels else None)
+            output_image = fast_engine.stylize(request['content_path'], request['fast_style'], size=size)
+            optimization = {'engine': 'fast', 'steps': 0, 'final_loss': None}
+            progress_callback(1, 1, None, job, request)
+        elif request['tiled']:
+            # High-resolution output, optimised in overlapping tiles
+            output_image, optimization = model.transfer_style_tiled(
+                request['content_path'], request['style_path'], **request['tiled'],
+                num_steps=TRANSFER_STEPS, workers=TRANSFER_TILE_WORKERS, optimizer=request['optimizer'],
+                tolerance=TRANSFER_TOLERANCE, window=TRANSFER_WINDOW,
+                progress_callback=job_progress_callback(job, request),
+                should_stop=lambda: job.cancel_requested, time_budget=request['time_budget'],
+                return_info=True
+            )
+            optimization['engine'] = 'optimize'
+        else:
+            # Perform style transfer
+            output_image, optimization = model.transfer_style(
+                request['content_path'], request['style_path'], num_steps=TRANSFER_STEPS,
+                optimizer=request['optimizer'], tolerance=TRANSFER_TOLERANCE, window=TRANSFER_WINDOW,
+                **request['pyramid'],
+                progress_callback=job_progress_callback(job, request),
+                preview_callback=job_preview_callback(job, request),
+                should_stop=lambda: job.cancel_requested, time_budget=request['time_budget'],
+                return_info=True
+            )
+            optimization['engine'] = 'optimize'
+        return finish_transfer_job(job, request, optimization, output_image=output_image)
+    except TransferCancelled:
+        record_cancelled_job(job)
+        raise
+    except Exception as e:
+        fail_transfer_job(job, request, e)
+        raise
+    finally:
+        metrics.stop_trace()
+
+def run_cached_transfer_job(job, request, cached):
+    """Complete a transfer from the result cache without running the model."""
+    cached_path, optimization = cached
+    try:
+        return finish_transfer_job(job, request, {**optimization, 'cached': True}, cached_path=cached_path)
+    except Exception as e:
+        fail_transfer_job(job, request, e)
+        raise
+
+def run_transfer_alone(job, request):
+    """Run one transfer, returning its result or the exception it failed with."""
+    try:
+        return run_transfer_job(job, request)
+    except Exception as e:
+        return e
+
+def run_transfer_batch(jobs, requests):
+    """Run a group of queued transfers; same-shaped Adam jobs share one batched optimisation."""
+    if len(jobs) == 1:
+        return [run_transfer_alone(jobs[0], requests[0])]
+    
+    # A batch shares its steps, so sampled jobs in it share one trace
+    traced = any(request['trace'] for request in requests)
+    if traced:
+        metrics.start_trace()
+    outputs = None
+    try:
+        outputs = model.transfer_style_batch(
+            [request['content_path'] for request in requests],
+            [request['style_path'] for request in requests],
+            num_steps=TRANSFER_STEPS, tolerance=TRANSFER_TOLERANCE, window=TRANSFER_WINDOW,
+            progress_callbacks=[job_progress_callback(job, request) for job, request in zip(jobs, requests)],
+            should_stops=[lambda job=job: job.cancel_requested for job in jobs],
+            time_budget=requests[0]['time_budget']
+        )
+    except TransferCancelled as e:
+        for job in jobs:
+            record_cancelled_job(job)
+        return [e] * len(jobs)
+    except Exception as e:
+        # One bad input, such as a truncated upload that only fails once it is fully
+        # decoded, must not fail the other jobs, so each one is retried on its own
+        logger.warning(f"Batched transfer of {len(jobs)} jobs failed, running them one by one: {str(e)}")
+    finally:
+        trace = metrics.stop_trace()
+    if outputs is None:
+        return [run_transfer_alone(job, request) for job, request in zip(jobs, requests)]
+    
+    results = []
+    for job, request, (output_image, optimization) in zip(jobs, requests, outputs):
+        if optimization.get('cancelled'):
+            record_cancelled_job(job)
+            results.append(TransferCancelled("Style transfer cancelled"))
+            continue
+        optimization['engine'] = 'optimize'
+        try:
+            results.append(finish_transfer_job(job, request, optimization, output_image=output_image,
+                                               trace=trace if request['trace'] else None))
+        except Exception as e:
+            fail_transfer_job(job, request, e)
+            results.append(e)
+    return results
+
+def finish_transfer_job(job, request, optimization, output_image=None, cached_path=None, trace=None):
+    """Save a finished transfer, record it in the user's history and notify the client.
+
+    The result is either a freshly computed output_image, which is also added to the
+    result cache, or the cached_path of an identical earlier transfer. A sampled job's
+    trace is taken from the current thread unless one is passed in.
+    """
+    email = request['email']
+    user_outputs, user_thumbnails = create_user_image_directories(email)
+    
+    # Generate output filename
+    output_filename = f'result_{request["timestamp"]}_{os.path.splitext(request["content_filename"])[0]}.jpg'
+    output_path = os.path.join(user_outputs, output_filename)
+    
+    # Save the output image; metadata comes from the image in memory, or from the
+    # cached file's header, instead of decoding the saved file again
+    if cached_path:
+        result_cache.materialize(cached_path, output_path)
+        with Image.open(output_path) as img:
+            width, height = img.size
+        source = output_path
+    else:
+        with metrics.phase('encode'):
+            output_image.save(output_path)
+        # A result cut short by its deadline is not what the same request would normally get
+        if not optimization.get('deadline_reached'):
+            result_cache.put(request['cache_key'], output_path, optimization)
+        width, height = output_image.size
+        source = output_image
+    
+    # Prepare image record; the full image stands in as thumbnail until derivatives exist
+    image_record = {
+        'filename': output_filename,
+        'original_filename': request['content_filename'],
+        'path': f'/outputs/{email}/{output_filename}',
+        'thumbnail_path': f'/outputs/{email}/{output_filename}',
+        'transformed_at': datetime.now().isoformat(),
+        'style_used': request['style_filename'],
+        'is_original': False,
+        'size': os.path.getsize(output_path),
+        'dimensions': {'width': width, 'height': height},
+        'derivatives': [],
+        'tags': []
+    }
+    trace = trace or metrics.stop_trace()
+    if trace:
+        image_record['trace'] = trace
+    
+    # Update user's image history
+    store.add_image(email, image_record)
+    
+    # Thumbnails and other sizes are encoded in the background and recorded when ready;
+    # the image is already saved, so if that fails the full image stays as thumbnail
+    try:
+        derivative_pipeline.submit(source, user_thumbnails, os.path.splitext(output_filename)[0],
+                                   on_done=lambda derivatives: record_derivatives(email, output_filename, derivatives))
+    except Exception as e:
+        logger.error(f"Error queueing derivatives for {output_filename}: {str(e)}")
+    
+    # Send final progress update
+    publish_progress(job, request, {
+        'current': 100,
+        'total': 100,
+        'loss': 0,
+        'percentage': 100,
+        'completed': True,
+        'image_data': image_record,
+        'optimization': optimization
+    })
+    
+    engine = 'cached' if cached_path else optimization['engine']
+    JOBS_TOTAL.inc(status='completed', engine=engine)
+    JOB_SECONDS.observe(time.monotonic() - request['submitted_at'], engine=engine)
+    return {**image_record, 'optimization': optimization}
+
+def fail_transfer_job(job, request, error):
+    logger.error(f"Error during style transfer: {str(error)}")
+    JOBS_TOTAL.inc(status='failed', engine='fast' if request['fast_style'] else 'optimize')
+    publish_progress(job, request, {
+        'failed': True,
+        'error': str(error)
+    })
+
+transfer_scheduler = BatchScheduler(job_manager, run_transfer_batch,
+                                    max_batch_size=TRANSFER_MAX_BATCH, batch_window=TRANSFER_BATCH_WINDOW)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Get the status and progress of a style transfer job"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; a running one stops before its next optimisation step"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    previous_status = job_manager.cancel(job)
+    if previous_status is None:
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    if previous_status == Job.PENDING:
+        # It never started, so nothing else will report it
+        record_cancelled_job(job)
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Get the image record produced by a finished style transfer job"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == Job.FAILED:
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status == Job.CANCELLED:
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    if not job.done:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    return job.result
+
+def warm_up_model():
+    """Load the VGG weights (compiling them if configured), then warm the style cache"""
+    global model_ready, model_load_error
+    try:
+        model.load()
+        model.warm_up()
+        model_ready = True
+    except Exception as e:
+        model_load_error = str(e)
+        logger.error(f"Error loading model: {str(e)}")
+        return
+    precompute_style_grams()
+
+def precompute_style_grams():
+    """Warm the style cache with every stock style image"""
+    for style_file in os.listdir(STYLE_FOLDER):
+        if not style_file.endswith(('.png', '.jpg', '.jpeg')):
+            continue
+        try:
+            model.get_style_grams(os.path.join(STYLE_FOLDER, style_file))
+        except Exception as e:
+            logger.error(f"Error precomputing style {style_file}: {str(e)}")
+    logger.info(f"Style cache warmed: {style_cache.stats()}")
+
+@app.on_event("startup")
+async def warm_style_cache():
+    # Run in the background so the server can start accepting requests
+    asyncio.get_running_loop().run_in_executor(None, warm_up_model)
+
+@app.get("/api/ready")
+async def readiness():
+    """503 until the model weights are loaded and warmed up, for load balancers and orchestrators"""
+    if model_ready:
+        return {"ready": True, "weights_memory_mapped": model.weights_mapped}
+    return JSONResponse(status_code=503, content={"ready": False, "error": model_load_error})
+
+@app.on_event("startup")
+async def start_progress_cleanup():
+    asyncio.create_task(cleanup_progress_channels())
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    transfer_scheduler.shutdown()
+    job_manager.shutdown()
+    derivative_pipeline.shutdown()
+
+@app.get("/api/cache-stats")
+async def get_cache_stats():
+    """Hit/miss counters and sizes of the style and result caches"""
+    return {"style_cache": style_cache.stats(), "result_cache": result_cache.stats()}
+
+def cache_lookups():
+    style_stats, result_stats = style_cache.stats(), result_cache.stats()
+    return {
+        ('style', 'hit'): style_stats['hits'],
+        ('style', 'disk_hit'): style_stats['disk_hits'],
+        ('style', 'miss'): style_stats['misses'],
+        ('result', 'hit'): result_stats['hits'],
+        ('result', 'miss'): result_stats['misses']
+    }
+
+def cache_hit_ratio():
+    lookups = cache_lookups()
+    ratios = {}
+    for cache in ('style', 'result'):
+        hits = sum(count for (name, outcome), count in lookups.items() if name == cache and outcome != 'miss')
+        total = hits + lookups[(cache, 'miss')]
+        ratios[cache] = hits / total if total else 0.0
+    return ratios
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'style_transfer_queue_depth', 'Jobs waiting for a worker', job_manager.queue_depth))
+metrics.REGISTRY.register(metrics.Gauge(
+    'style_transfer_active_jobs', 'Jobs running on a worker', job_manager.active_count))
+metrics.REGISTRY.register(metrics.Gauge(
+    'style_transfer_active_websockets', 'Connected progress websockets', progress_hub.subscriber_count))
+metrics.REGISTRY.register(metrics.Gauge(
+    'style_transfer_cache_lookups_total', 'Style Gram and result cache lookups by outcome', cache_lookups,
+    labelnames=['cache', 'outcome'], metric_type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'style_transfer_cache_hit_ratio', 'Share of cache lookups answered from memory or disk', cache_hit_ratio,
+    labelnames=['cache']))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Phase timings, job counters, queue and cache gauges in the Prometheus text format"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/styles")
 async def get_available_styles():
     try:
@@ -505,53 +1093,18 @@ async def get_available_styles():
         logger.error(f"Error fetching styles: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# Load users from JSON file
-def load_users():
-    try:
-        with open('users.json', 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"users": []}
-
-# Save users to JSON file
-def save_users(users_data):
-    with open('users.json', 'w') as f:
-        json.dump(users_data, f, indent=4)
-
 @app.post("/api/update-user")
 async def update_user(user_data: dict):
     try:
         logger.info(f"Updating user information for: {user_data['email']}")
-        users_data = load_users()
-        
-        # Find if user exists
-        user_exists = False
-        for user in users_data["users"]:
-            if user["email"] == user_data["email"]:
-                # Update existing user
-                user.update({
-                    "name": user_data["name"],
-                    "uid": user_data["uid"],
-                    "last_login": user_data["last_login"]
-                })
-                user_exists = True
-                logger.info(f"Updated existing user: {user_data['email']}")
-                break
-        
-        # If user doesn't exist, add new user
-        if not user_exists:
-            new_user = {
-                "name": user_data["name"],
-                "email": user_data["email"],
-                "uid": user_data["uid"],
-                "last_login": user_data["last_login"],
-                "transformed_images": []
-            }
-            users_data["users"].append(new_user)
-            logger.info(f"Added new user: {user_data['email']}")
-        
-        # Save updated users data
-        save_users(users_data)
+        # Update existing user, or add new user if it doesn't exist
+        store.upsert_user({
+            "name": user_data["name"],
+            "email": user_data["email"],
+            "uid": user_data["uid"],
+            "last_login": user_data["last_login"]
+        })
+        logger.info(f"Updated user: {user_data['email']}")
         return {"message": "User information updated successfully"}
     except Exception as e:
         logger.error(f"Error updating user: {str(e)}")
@@ -561,33 +1114,21 @@ async def update_user(user_data: dict):
 async def add_transformed_image(image_data: dict):
     try:
         logger.info(f"Adding transformed image for user: {image_data['email']}")
-        users_data = load_users()
-        
-        # Find user
-        user_found = False
-        for user in users_data["users"]:
-            if user["email"] == image_data["email"]:
-                # Add transformed image to user's history
-                if "transformed_images" not in user:
-                    user["transformed_images"] = []
-                
-                user["transformed_images"].append({
-                    "image_path": image_data["image_path"],
-                    "style_name": image_data["style_name"],
-                    "transformed_at": image_data["transformed_at"]
-                })
-                
-                user_found = True
-                logger.info(f"Added transformed image for user: {image_data['email']}")
-                break
+        # Add transformed image to user's history
+        user_found = store.add_image(image_data["email"], {
+            "image_path": image_data["image_path"],
+            "style_name": image_data["style_name"],
+            "transformed_at": image_data["transformed_at"]
+        })
         
         if not user_found:
             logger.warning(f"User not found: {image_data['email']}")
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Save updated users data
-        save_users(users_data)
+        logger.info(f"Added transformed image for user: {image_data['email']}")
         return {"message": "Transformed image added successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error adding transformed image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -595,19 +1136,19 @@ async def add_transformed_image(image_data: dict):
 @app.get("/api/user-history/{email}")
 async def get_user_history(email: str):
     try:
-        users_data = load_users()
-        
         # Find user
-        for user in users_data["users"]:
-            if user["email"] == email:
-                return {
-                    "name": user["name"],
-                    "email": user["email"],
-                    "last_login": user["last_login"],
-                    "transformed_images": user.get("transformed_images", [])
-                }
+        user = store.get_user(email)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
         
-        raise HTTPException(status_code=404, detail="User not found")
+        return {
+            "name": user["name"],
+            "email": user["email"],
+            "last_login": user["last_login"],
+            "transformed_images": store.list_images(email)
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting user history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -625,7 +1166,10 @@ if __name__ == '__main__':
             host=host,
             port=port,
             reload=False,  # Disable reload in production
-            log_level="info"  # Use info level in production
+            log_level="info",  # Use info level in production
+            # Jobs, progress channels and caches live in this process, so it must be
+            # the only one; set explicitly so uvicorn ignores WEB_CONCURRENCY
+            workers=1
         )
     except Exception as e:
         print(f"Error starting server: {str(e)}")
@@ -0,0 +1,292 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.models.vgg import cfgs as vgg_cfgs, make_layers
+
+from model import StyleTransferModel
+from storage import UserStore
+from style_cache import StyleFeatureCache
+
+SECTIONS = ('features', 'transfer', 'store', 'api')
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(func, repeat):
+    """Median and minimum wall time of repeat calls, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    return {'median_ms': statistics.median(times), 'min_ms': min(times)}
+
+
+def random_image(width, height, seed):
+    """A smooth random RGB image, so benchmarks need no image files."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, size=(max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    return Image.fromarray(small).resize((width, height), Image.BILINEAR)
+
+
+def image_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def prepare_weights(weights_path, work_dir):
+    """Use a local weights file when there is one, otherwise export randomly initialised layers."""
+    if weights_path and os.path.exists(weights_path):
+        return os.path.abspath(weights_path), 'file'
+    path = os.path.join(work_dir, 'vgg19_features_random.pt')
+    model = StyleTransferModel(weights_path=None, allow_download=False, lazy=True)
+    StyleTransferModel.save_vgg_weights(make_layers(vgg_cfgs['E'])[:model.feature_depth(model.layers)], path)
+    return path, 'random'
+
+
+def bench_features(model, resolutions, repeat):
+    """Forward (no grad) and forward+backward time of get_features per square resolution."""
+    results = []
+    for size in resolutions:
+        image = torch.rand(1, 3, size, size, device=model.device)
+        with torch.no_grad():
+            model.get_features(image)
+
+        def forward():
+            with torch.no_grad():
+                model.get_features(image)
+
+        def backward():
+            target = image.clone().requires_grad_(True)
+            features = model.get_features(target)
+            sum(feature.mean() for feature in features.values()).backward()
+
+        results.append({'resolution': size, 'forward': timed(forward, repeat),
+                        'forward_backward': timed(backward, repeat)})
+    return results
+
+
+def bench_transfer(model, work_dir, sizes, steps):
+    """Steps/sec of transfer_style at each working resolution (shorter edge)."""
+    content_path = os.path.join(work_dir, 'content.jpg')
+    style_path = os.path.join(work_dir, 'style.jpg')
+    random_image(640, 480, seed=1).save(content_path)
+    random_image(512, 512, seed=2).save(style_path)
+
+    results = []
+    for size in sizes:
+        # Untimed run so style Grams are cached and lazy setup is done
+        model.transfer_style(content_path, style_path, levels=[size], level_steps=[1])
+        started = time.perf_counter()
+        _, info = model.transfer_style(content_path, style_path, levels=[size], level_steps=[steps],
+                                       return_info=True)
+        seconds = time.perf_counter() - started
+        results.append({'resolution': size, 'steps': info['steps'], 'seconds': seconds,
+                        'steps_per_second': info['steps'] / seconds})
+    return results
+
+
+def bench_store(work_dir, user_counts, samples, images_per_user):
+    """Per-operation cost of the UserStore calls that replaced load_users/save_users."""
+    results = []
+    rng = np.random.default_rng(0)
+    for count in user_counts:
+        store = UserStore(os.path.join(work_dir, f'users_{count}.db'), legacy_json_path=None)
+        emails = [f'user{i}@example.com' for i in range(count)]
+
+        started = time.perf_counter()
+        for email in emails:
+            store.create_user({'email': email, 'name': email, 'uid': email, 'is_verified': False,
+                               'created_at': datetime.now().isoformat(),
+                               'last_login': datetime.now().isoformat()})
+        create_ms = (time.perf_counter() - started) * 1000 / count
+
+        picks = [emails[i] for i in rng.integers(0, count, size=samples)]
+        heavy = emails[0]
+        started = time.perf_counter()
+        for i in range(images_per_user):
+            store.add_image(heavy, {'filename': f'result_{i}.jpg', 'transformed_at': datetime.now().isoformat(),
+                                   'tags': []})
+        add_image_ms = (time.perf_counter() - started) * 1000 / images_per_user
+
+        cursor = None
+        for _ in range(images_per_user // 40):
+            _, cursor = store.page_images(heavy, 20, cursor=cursor)
+
+        results.append({
+            'users': count,
+            'create_user_ms': create_ms,
+            'get_user': timed(lambda: [store.get_user(email) for email in picks], 1)['median_ms'] / samples,
+            'user_exists': timed(lambda: [store.user_exists(email) for email in picks], 1)['median_ms'] / samples,
+            'update_user': timed(lambda: [store.update_user(email, {'last_login': datetime.now().isoformat()})
+                                          for email in picks], 1)['median_ms'] / samples,
+            'add_image_ms': add_image_ms,
+            'first_page': timed(lambda: store.page_images(heavy, 20), samples),
+            'deep_page': timed(lambda: store.page_images(heavy, 20, cursor=cursor), samples),
+            'count_images': timed(lambda: store.count_images(heavy), samples)
+        })
+    return results
+
+
+def bench_api(work_dir, weights_path, client_counts, requests_per_client, steps):
+    """Latency and throughput of /api/transfer through an in-process test client."""
+    from fastapi.testclient import TestClient
+
+    # The app keeps its state relative to the working directory, so run it in a scratch one
+    api_dir = os.path.join(work_dir, 'api')
+    os.makedirs(api_dir, exist_ok=True)
+    previous_dir = os.getcwd()
+    os.chdir(api_dir)
+    try:
+        os.environ.update({'VGG_WEIGHTS_PATH': weights_path, 'VGG_ALLOW_DOWNLOAD': '0'})
+        import app as server
+        # A fixed step count, so runs stay comparable
+        server.TRANSFER_STEPS = steps
+        server.TRANSFER_TOLERANCE = None
+
+        email = 'bench@example.com'
+        style = image_bytes(random_image(256, 256, seed=2))
+        seed = iter(range(1000, 10 ** 9))
+        results = []
+        with TestClient(server.app) as client:
+            client.post('/api/register', json={'name': 'bench', 'email': email, 'password': 'bench', 'uid': 'bench'})
+            while client.get('/api/ready').status_code != 200:
+                time.sleep(0.1)
+
+            for clients in client_counts:
+                latencies = []
+                lock = threading.Lock()
+                # Distinct content per request, so no request is answered from the result cache
+                payloads = [[image_bytes(random_image(320, 240, seed=next(seed))) for _ in range(requests_per_client)]
+                            for _ in range(clients)]
+
+                def run_client(index):
+                    for number, content in enumerate(payloads[index]):
+                        started = time.perf_counter()
+                        response = client.post('/api/transfer', data={'email': email, 'client_id': f'bench-{index}-{number}'},
+                                               files={'content': ('content.jpg', content, 'image/jpeg'),
+                                                      'style': ('style.jpg', style, 'image/jpeg')})
+                        job_id = response.json()['job_id']
+                        while client.get(f'/api/jobs/{job_id}').json()['status'] not in ('completed', 'failed'):
+                            time.sleep(0.02)
+                        with lock:
+                            latencies.append((time.perf_counter() - started) * 1000)
+
+                threads = [threading.Thread(target=run_client, args=(index,)) for index in range(clients)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                seconds = time.perf_counter() - started
+
+                latencies.sort()
+                results.append({
+                    'clients': clients,
+                    'requests': len(latencies),
+                    'throughput_per_second': len(latencies) / seconds,
+                    'latency_ms': {
+                        'median': statistics.median(latencies),
+                        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                        'max': latencies[-1]
+                    }
+                })
+            # Let background thumbnail encoding finish before the scratch directory goes away
+            server.derivative_pipeline.shutdown(wait=True)
+    finally:
+        os.chdir(previous_dir)
+    return results
+
+
+def parse_ints(value):
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the style transfer engine and API")
+    parser.add_argument('--sections', default=','.join(SECTIONS), help=f"comma separated subset of {', '.join(SECTIONS)}")
+    parser.add_argument('--weights', default=os.path.join('weights', 'vgg19_features.pt'),
+                        help="VGG feature weights; randomly initialised weights are used when missing")
+    parser.add_argument('--resolutions', type=parse_ints, default=[128, 256, 512])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--transfer-sizes', type=parse_ints, default=[128, 256])
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--user-counts', type=parse_ints, default=[100, 1000, 10000])
+    parser.add_argument('--images-per-user', type=int, default=1000)
+    parser.add_argument('--clients', type=parse_ints, default=[1, 2, 4])
+    parser.add_argument('--requests-per-client', type=int, default=2)
+    parser.add_argument('--api-steps', type=int, default=20)
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    sections = [section for section in args.sections.split(',') if section]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown section(s): {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        weights_path, weights = prepare_weights(args.weights, work_dir)
+        results = {
+            'environment': {
+                'python': platform.python_version(),
+                'torch': torch.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'torch_threads': torch.get_num_threads(),
+                'weights': weights
+            },
+            'config': {key: value for key, value in vars(args).items() if key != 'output'},
+            'started_at': datetime.now().isoformat()
+        }
+
+        model = None
+        if 'features' in sections or 'transfer' in sections:
+            model = StyleTransferModel(style_cache=StyleFeatureCache(cache_dir=os.path.join(work_dir, 'grams')),
+                                       weights_path=weights_path, allow_download=False)
+        if 'features' in sections:
+            results['features'] = bench_features(model, args.resolutions, args.repeat)
+            results['features_peak_rss_mb'] = peak_rss_mb()
+        if 'transfer' in sections:
+            results['transfer'] = bench_transfer(model, work_dir, args.transfer_sizes, args.steps)
+            results['transfer_peak_rss_mb'] = peak_rss_mb()
+        if 'store' in sections:
+            results['store'] = bench_store(work_dir, args.user_counts, min(args.user_counts + [1000]),
+                                           args.images_per_user)
+            results['store_peak_rss_mb'] = peak_rss_mb()
+        if 'api' in sections:
+            results['api'] = bench_api(work_dir, weights_path, args.clients, args.requests_per_client,
+                                       args.api_steps)
+            results['api_peak_rss_mb'] = peak_rss_mb()
+        results['peak_rss_mb'] = peak_rss_mb()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
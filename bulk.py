@@ -0,0 +1,222 @@
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import torch
+
+from model import StyleTransferModel
+from style_cache import StyleFeatureCache
+
+STYLE_FOLDER = 'styles'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+OUTPUT_FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+# One model per worker process, created by init_worker
+_model = None
+
+
+def init_worker(weights_path, threads, cache_dir, options):
+    """Process pool initializer: pin the thread count and load this worker's model."""
+    global _model
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    torch.set_num_threads(threads)
+    # Workers mmap the same weights file, so its pages are shared between them
+    _model = StyleTransferModel(style_cache=StyleFeatureCache(cache_dir=cache_dir), weights_path=weights_path)
+    _model.configure(channels_last=options['channels_last'], bf16=options['bf16'], num_threads=threads)
+
+
+def process_task(task, settings):
+    """Stylize one (content, style) pair and write it to task['output'] atomically."""
+    started = time.perf_counter()
+    image, info = _model.transfer_style(
+        task['content'], task['style'], num_steps=settings['steps'], optimizer=settings['optimizer'],
+        tolerance=settings['tolerance'], window=settings['window'],
+        levels=[settings['size']] if settings['size'] else None, return_info=True)
+    # Written under a temporary name first, so an interrupted write never looks finished
+    os.makedirs(os.path.dirname(task['output']), exist_ok=True)
+    tmp_path = f"{task['output']}.{os.getpid()}.tmp"
+    image.save(tmp_path, format=OUTPUT_FORMATS[settings['format']], quality=settings['quality'])
+    os.replace(tmp_path, task['output'])
+    return {**task, 'steps': info['steps'], 'final_loss': info['final_loss'],
+            'seconds': time.perf_counter() - started, 'finished_at': datetime.now().isoformat()}
+
+
+def resolve_styles(styles):
+    """Style arguments are image paths or names of files in styles/; none means every stock style."""
+    if not styles:
+        return [os.path.join(STYLE_FOLDER, name) for name in sorted(os.listdir(STYLE_FOLDER))
+                if name.lower().endswith(IMAGE_EXTENSIONS)]
+    resolved = []
+    for style in styles:
+        path = style if os.path.exists(style) else os.path.join(STYLE_FOLDER, style)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Style not found: {style}")
+        resolved.append(path)
+    return resolved
+
+
+def glob_root(pattern):
+    """Directory part of a glob before its first wildcard, e.g. 'catalogue' for 'catalogue/**/*.jpg'."""
+    parts = pattern.replace(os.sep, '/').split('/')
+    root = []
+    for part in parts[:-1]:
+        if glob.has_magic(part):
+            break
+        root.append(part)
+    return '/'.join(root) or ('/' if pattern.startswith('/') else '.')
+
+
+def build_tasks(patterns, styles, output_dir, output_format):
+    """Every content/style pair, grouped by style so workers reuse their cached Grams.
+
+    Outputs mirror each input's path below its glob root, so equally named files in
+    different folders do not collide; inputs that would still share an output name
+    (e.g. x.png and x.jpg side by side) raise ValueError.
+    """
+    contents = {}
+    for pattern in patterns:
+        root = glob_root(pattern)
+        for path in glob.glob(pattern, recursive=True):
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                contents.setdefault(path, os.path.splitext(os.path.relpath(path, root))[0])
+    
+    stems = {}
+    for path, stem in sorted(contents.items()):
+        stems.setdefault(stem, []).append(path)
+    duplicates = [paths for paths in stems.values() if len(paths) > 1]
+    if duplicates:
+        raise ValueError("Inputs would share an output name: " + '; '.join(', '.join(paths) for paths in duplicates))
+    
+    tasks = []
+    for style in styles:
+        style_stem = os.path.splitext(os.path.basename(style))[0]
+        for content, content_stem in sorted(contents.items()):
+            tasks.append({
+                'content': content,
+                'style': style,
+                'output': os.path.join(output_dir, f'{content_stem}__{style_stem}.{output_format}')
+            })
+    return tasks
+
+
+class Manifest:
+    """Append-only JSON lines record of finished outputs, used to resume interrupted runs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['output'])
+                    except (ValueError, KeyError):
+                        # A line cut short by the interruption
+                        continue
+        self.file = open(path, 'a')
+
+    def is_done(self, task):
+        return task['output'] in self.done and os.path.exists(task['output'])
+
+    def record(self, result):
+        self.file.write(json.dumps(result) + '\n')
+        self.file.flush()
+        self.done.add(result['output'])
+
+    def close(self):
+        self.file.close()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stylize folders of images offline with a pool of worker processes")
+    parser.add_argument('--input', required=True, action='append',
+                        help="glob of content images, e.g. 'catalogue/**/*.jpg' (repeatable)")
+    parser.add_argument('--style', action='append', help="style image path or name in styles/ (repeatable; "
+                                                         "default: every stock style)")
+    parser.add_argument('--output', required=True, help="output directory")
+    parser.add_argument('--format', default='jpg', choices=sorted(OUTPUT_FORMATS))
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--size', type=int, default=None, help="working resolution, shorter edge in pixels")
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--optimizer', default='adam', choices=StyleTransferModel.OPTIMIZERS)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    parser.add_argument('--window', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help="worker processes, each with its own model")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="intra-op threads per worker (default: CPU count divided by --workers)")
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--bf16', action='store_true')
+    parser.add_argument('--weights', default=os.path.join('weights', 'vgg19_features.pt'))
+    parser.add_argument('--manifest', help="completion manifest (default: OUTPUT/manifest.jsonl)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    logger = logging.getLogger('bulk')
+    os.makedirs(args.output, exist_ok=True)
+
+    try:
+        tasks = build_tasks(args.input, resolve_styles(args.style), args.output, args.format)
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+    manifest = Manifest(args.manifest or os.path.join(args.output, 'manifest.jsonl'))
+    pending = [task for task in tasks if not manifest.is_done(task)]
+    logger.info(f"{len(tasks)} outputs, {len(tasks) - len(pending)} already done, {len(pending)} to go")
+    if not pending:
+        manifest.close()
+        return
+
+    # Split the cores between workers so they do not oversubscribe each other
+    workers = max(1, min(args.workers, len(pending)))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+    settings = {'steps': args.steps, 'optimizer': args.optimizer, 'tolerance': args.tolerance,
+                'window': args.window, 'size': args.size, 'format': args.format, 'quality': args.quality}
+    options = {'channels_last': args.channels_last, 'bf16': args.bf16}
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker,
+        initargs=(os.path.abspath(args.weights), threads, os.path.join('cache', 'style_grams'), options))
+    logger.info(f"Running on {workers} worker(s) with {threads} thread(s) each")
+
+    started = time.perf_counter()
+    finished = failed = 0
+    try:
+        futures = {executor.submit(process_task, task, settings): task for task in pending}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                manifest.record(future.result())
+                finished += 1
+            except Exception as e:
+                failed += 1
+                logger.error(f"Failed {task['content']} with {task['style']}: {str(e)}")
+            done = finished + failed
+            rate = finished / (time.perf_counter() - started)
+            eta = format_duration((len(pending) - done) / rate) if rate else '?'
+            logger.info(f"{done}/{len(pending)} ({failed} failed), {rate:.2f} images/s, ETA {eta}")
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; rerun the same command to resume")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        manifest.close()
+    executor.shutdown()
+
+    seconds = time.perf_counter() - started
+    logger.info(f"Finished {finished} image(s) in {format_duration(seconds)} "
+                f"({finished / seconds:.2f} images/s), {failed} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from model import StyleTransferModel
+from style_cache import StyleFeatureCache
+
+MODE_FLAGS = ('channels_last', 'bf16', 'compile')
+DEFAULT_MODES = ['baseline', 'channels_last', 'bf16', 'compile', 'channels_last+bf16+compile']
+
+
+def parse_mode(mode):
+    """'channels_last+bf16' -> {'channels_last': True, 'bf16': True, 'compile': False}"""
+    flags = set() if mode == 'baseline' else set(mode.split('+'))
+    unknown = flags - set(MODE_FLAGS)
+    if unknown:
+        raise ValueError(f"Unknown mode flag(s) {', '.join(sorted(unknown))}, expected {', '.join(MODE_FLAGS)}")
+    return {flag: flag in flags for flag in MODE_FLAGS}
+
+
+def image_difference(image, reference):
+    """Mean/max absolute pixel difference (0-255) and PSNR of image against reference."""
+    a = np.asarray(image, dtype=np.float64)
+    b = np.asarray(reference, dtype=np.float64)
+    diff = np.abs(a - b)
+    mse = float((diff ** 2).mean())
+    return {
+        'mean_abs_diff': float(diff.mean()),
+        'max_abs_diff': float(diff.max()),
+        'psnr': float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+    }
+
+
+def run_mode(mode, content_path, style_path, steps, weights_path, num_threads=None):
+    """Time transfer_style under one execution mode and return (image, report)."""
+    flags = parse_mode(mode)
+    # A fresh Gram cache per mode so each mode computes its own style statistics
+    with tempfile.TemporaryDirectory() as cache_dir:
+        model = StyleTransferModel(style_cache=StyleFeatureCache(cache_dir=cache_dir), weights_path=weights_path,
+                                   allow_download=False)
+        model.configure(num_threads=num_threads, **flags)
+
+        # Warm up on the real inputs too, so compilation for their shape is not timed
+        started = time.perf_counter()
+        model.warm_up()
+        model.transfer_style(content_path, style_path, num_steps=2)
+        warm_up_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        image, info = model.transfer_style(content_path, style_path, num_steps=steps, return_info=True)
+        seconds = time.perf_counter() - started
+
+    return image, {
+        'mode': mode,
+        **flags,
+        'bf16_active': model.autocast_dtype is not None,
+        'threads': torch.get_num_threads(),
+        'warm_up_seconds': warm_up_seconds,
+        'seconds': seconds,
+        'steps': info['steps'],
+        'steps_per_second': info['steps'] / seconds,
+        'final_loss': info['final_loss']
+    }
+
+
+def compare_modes(content_path, style_path, modes=DEFAULT_MODES, steps=100,
+                  weights_path=os.path.join('weights', 'vgg19_features.pt'), num_threads=None):
+    """Run every mode on the same inputs; differences are measured against the first mode."""
+    reports = []
+    reference = None
+    for mode in modes:
+        image, report = run_mode(mode, content_path, style_path, steps, weights_path, num_threads)
+        if reference is None:
+            reference = image
+        report.update(image_difference(image, reference))
+        report['speedup'] = report['steps_per_second'] / reports[0]['steps_per_second'] if reports else 1.0
+        reports.append(report)
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare steps/sec and output drift of CPU execution modes")
+    parser.add_argument('--content', required=True, help="content image")
+    parser.add_argument('--style', required=True, help="style image")
+    parser.add_argument('--modes', default=','.join(DEFAULT_MODES),
+                        help="comma separated modes; combine flags with '+', e.g. channels_last+bf16")
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=None, help="intra-op threads (default: torch's choice)")
+    parser.add_argument('--weights', default=os.path.join('weights', 'vgg19_features.pt'))
+    parser.add_argument('--output', help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+    reports = compare_modes(args.content, args.style, modes=args.modes.split(','), steps=args.steps,
+                            weights_path=args.weights, num_threads=args.threads)
+
+    print(f"{'mode':<30} {'steps/s':>8} {'speedup':>8} {'mean diff':>10} {'max diff':>9} {'psnr':>7}")
+    for report in reports:
+        print(f"{report['mode']:<30} {report['steps_per_second']:>8.2f} {report['speedup']:>7.2f}x "
+              f"{report['mean_abs_diff']:>10.2f} {report['max_abs_diff']:>9.0f} {report['psnr']:>7.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
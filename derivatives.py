@@ -0,0 +1,143 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, List, Optional, Union
+
+from PIL import Image, features
+
+import metrics
+
+# Pillow format name, file extension and MIME type of each derivative format
+FORMATS = {
+    'avif': ('AVIF', 'avif', 'image/avif'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+
+
+def supported_formats() -> List[str]:
+    """Derivative formats this Pillow build can encode, most compact first."""
+    Image.init()
+    available = []
+    for name in ('avif', 'webp'):
+        # Older Pillow builds only encode AVIF through a plugin registered in Image.SAVE
+        if features.check(name) if name in features.modules else FORMATS[name][0] in Image.SAVE:
+            available.append(name)
+    available.append('jpeg')
+    return available
+
+
+def render_derivatives(image: Union[Image.Image, str], output_dir: str, stem: str,
+                       sizes: Iterable[int], formats: Iterable[str], quality: int = 80) -> List[dict]:
+    """Write every size/format combination of image and describe the files written.
+
+    Runs inside a worker process. Sizes bound the longer edge; sizes at or above the
+    image's own dimensions are skipped rather than upscaled.
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+    image = image.convert('RGB')
+    derivatives = []
+    for size in sorted(sizes):
+        if size >= max(image.size) and derivatives:
+            break
+        resized = image.copy()
+        resized.thumbnail((size, size))
+        for name in formats:
+            pil_format, extension, mime_type = FORMATS[name]
+            path = os.path.join(output_dir, f'{stem}_{size}.{extension}')
+            resized.save(path, format=pil_format, quality=quality)
+            derivatives.append({
+                'width': resized.width,
+                'height': resized.height,
+                'format': name,
+                'mime_type': mime_type,
+                'file': os.path.basename(path),
+                'size': os.path.getsize(path)
+            })
+    return derivatives
+
+
+class DerivativePipeline:
+    """Generate resized copies of finished images in a pool of worker processes.
+
+    Encoding several sizes and formats is CPU-bound, so it runs outside the server
+    process and its GIL; callers get a future and are notified when the files exist.
+    """
+
+    def __init__(self, sizes: Iterable[int] = (200, 400, 800), formats: Optional[Iterable[str]] = None,
+                 max_workers: int = 2, quality: int = 80):
+        self.logger = logging.getLogger(__name__)
+        self.sizes = tuple(sizes)
+        available = supported_formats()
+        self.formats = [name for name in (formats or available) if name in available]
+        self.quality = quality
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = self._new_executor()
+        self.logger.info(f"Derivative pipeline: sizes {self.sizes}, formats {self.formats}")
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked so workers do not inherit the model's threads
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, image: Union[Image.Image, str], output_dir: str, stem: str,
+               on_done: Optional[Callable[[List[dict]], None]] = None) -> Future:
+        """Queue derivatives of an in-memory image (or an image file) and return a future.
+
+        A pool broken by a dead worker is replaced once; if the new pool cannot take
+        the job either, BrokenProcessPool is raised to the caller.
+        """
+        if isinstance(image, str):
+            image = os.path.abspath(image)
+        submitted = time.perf_counter()
+        args = (render_derivatives, image, os.path.abspath(output_dir), stem, self.sizes, self.formats, self.quality)
+        executor = self.executor
+        try:
+            future = executor.submit(*args)
+        except BrokenProcessPool:
+            with self.lock:
+                # Another thread may have replaced the pool already
+                if self.executor is executor:
+                    self.logger.warning("Derivative worker pool broke, starting a new one")
+                    executor.shutdown(wait=False)
+                    self.executor = self._new_executor()
+                executor = self.executor
+            future = executor.submit(*args)
+        future.add_done_callback(lambda f: self._finish(f, stem, submitted, on_done))
+        return future
+
+    def _finish(self, future: Future, stem: str, submitted: float,
+                on_done: Optional[Callable[[List[dict]], None]]):
+        if future.cancelled():
+            return
+        # Includes time queued behind other jobs' derivatives
+        metrics.observe_phase('derivatives', time.perf_counter() - submitted)
+        if not on_done:
+            return
+        try:
+            on_done(future.result())
+        except Exception as e:
+            self.logger.error(f"Error creating derivatives for {stem}: {str(e)}")
+
+    @staticmethod
+    def pick(derivatives: List[dict], width: int, accept: str = '') -> Optional[dict]:
+        """Smallest derivative at least width pixels wide, in the best format accept allows.
+
+        Falls back to the largest derivative when none is wide enough.
+        """
+        usable = [d for d in derivatives if d['format'] == 'jpeg' or d['mime_type'] in accept]
+        if not usable:
+            return None
+        wide_enough = [d for d in usable if max(d['width'], d['height']) >= width]
+        if wide_enough:
+            return min(wide_enough, key=lambda d: (max(d['width'], d['height']), d['size']))
+        return max(usable, key=lambda d: (max(d['width'], d['height']), -d['size']))
+
+    def shutdown(self, wait: bool = False):
+        """Stop the workers; with wait=True queued derivatives are finished first."""
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
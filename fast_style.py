@@ -0,0 +1,230 @@
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from PIL import Image
+from torchvision import transforms
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file's raw bytes."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConvLayer(nn.Module):
+    """Reflection padded convolution."""
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride):
+        super().__init__()
+        self.pad = nn.ReflectionPad2d(kernel_size // 2)
+        self.conv = nn.Conv2d(in_channels, out_channels, kernel_size, stride)
+
+    def forward(self, x):
+        return self.conv(self.pad(x))
+
+
+class ResidualBlock(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.conv1 = ConvLayer(channels, channels, 3, 1)
+        self.in1 = nn.InstanceNorm2d(channels, affine=True)
+        self.conv2 = ConvLayer(channels, channels, 3, 1)
+        self.in2 = nn.InstanceNorm2d(channels, affine=True)
+        self.relu = nn.ReLU()
+
+    def forward(self, x):
+        out = self.relu(self.in1(self.conv1(x)))
+        out = self.in2(self.conv2(out))
+        return out + x
+
+
+class UpsampleConvLayer(nn.Module):
+    """Nearest neighbour upsampling followed by a convolution, which avoids checkerboard artefacts."""
+
+    def __init__(self, in_channels, out_channels, kernel_size, upsample):
+        super().__init__()
+        self.upsample = nn.Upsample(scale_factor=upsample, mode='nearest')
+        self.conv = ConvLayer(in_channels, out_channels, kernel_size, 1)
+
+    def forward(self, x):
+        return self.conv(self.upsample(x))
+
+
+class TransformerNet(nn.Module):
+    """Image transformation network from Johnson et al., "Perceptual Losses for Real-Time Style Transfer".
+
+    It maps a normalised image tensor to a stylised tensor in the same normalised
+    space, so StyleTransferModel.tensor_to_image can convert its output directly.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.relu = nn.ReLU()
+        self.conv1 = ConvLayer(3, 32, 9, 1)
+        self.in1 = nn.InstanceNorm2d(32, affine=True)
+        self.conv2 = ConvLayer(32, 64, 3, 2)
+        self.in2 = nn.InstanceNorm2d(64, affine=True)
+        self.conv3 = ConvLayer(64, 128, 3, 2)
+        self.in3 = nn.InstanceNorm2d(128, affine=True)
+        self.residuals = nn.Sequential(*[ResidualBlock(128) for _ in range(5)])
+        self.deconv1 = UpsampleConvLayer(128, 64, 3, 2)
+        self.in4 = nn.InstanceNorm2d(64, affine=True)
+        self.deconv2 = UpsampleConvLayer(64, 32, 3, 2)
+        self.in5 = nn.InstanceNorm2d(32, affine=True)
+        self.deconv3 = ConvLayer(32, 3, 9, 1)
+
+    def forward(self, x):
+        size = x.shape[-2:]
+        y = self.relu(self.in1(self.conv1(x)))
+        y = self.relu(self.in2(self.conv2(y)))
+        y = self.relu(self.in3(self.conv3(y)))
+        y = self.residuals(y)
+        y = self.relu(self.in4(self.deconv1(y)))
+        y = self.relu(self.in5(self.deconv2(y)))
+        y = self.deconv3(y)
+        # Odd input sizes come back a pixel or two larger after the down/up path
+        return y[..., :size[0], :size[1]]
+
+
+class FastStyleEngine:
+    """Serve trained TransformerNets, looked up by the SHA-256 of their style image file."""
+
+    def __init__(self, model, models_dir: str = 'fast_models'):
+        self.logger = logging.getLogger(__name__)
+        self.model = model
+        self.models_dir = models_dir
+        self.index: Dict[str, str] = {}
+        self.nets: Dict[str, TransformerNet] = {}
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Rescan models_dir for trained networks."""
+        index = {}
+        for path in glob.glob(os.path.join(self.models_dir, '*.pth')):
+            try:
+                checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+                index[checkpoint['style_sha256']] = path
+            except Exception as e:
+                self.logger.error(f"Skipping unreadable fast style model {path}: {str(e)}")
+        with self.lock:
+            self.index = index
+            self.nets = {key: net for key, net in self.nets.items() if key in index}
+        self.logger.info(f"Fast style engine found {len(index)} trained style(s)")
+
+    def has_style(self, style_sha256: str) -> bool:
+        return style_sha256 in self.index
+
+    def get_net(self, style_sha256: str) -> TransformerNet:
+        with self.lock:
+            net = self.nets.get(style_sha256)
+            if net is None:
+                checkpoint = torch.load(self.index[style_sha256], map_location='cpu', weights_only=True)
+                net = TransformerNet()
+                net.load_state_dict(checkpoint['state_dict'])
+                net = net.to(self.model.device).eval()
+                self.nets[style_sha256] = net
+            return net
+
+    def stylize(self, content_path: str, style_sha256: str, size=None) -> Image.Image:
+        """Stylise a content image with a single forward pass."""
+        net = self.get_net(style_sha256)
+        content = self.model.load_image(content_path, max_size=size)
+        with torch.no_grad():
+            output = net(content)
+        return self.model.tensor_to_image(output)
+
+
+def train(model, style_path: str, dataset: str, output_dir: str = 'fast_models', epochs: int = 2,
+          batch_size: int = 4, image_size: int = 256, lr: float = 1e-3,
+          content_weight: float = 1e5, style_weight: float = 1e10, log_interval: int = 100) -> str:
+    """Fit a TransformerNet to one style using the VGG loss network of a StyleTransferModel."""
+    logger = logging.getLogger(__name__)
+    paths = sorted(p for p in glob.glob(os.path.join(dataset, '**', '*'), recursive=True)
+                   if p.lower().endswith(('.png', '.jpg', '.jpeg')))
+    if not paths:
+        raise ValueError(f"No training images found in {dataset}")
+
+    crop = transforms.Compose([transforms.Resize(image_size), transforms.CenterCrop(image_size)])
+
+    style_grams = model.get_style_grams(style_path, size=image_size)
+    net = TransformerNet().to(model.device).train()
+    optimizer = optim.Adam(net.parameters(), lr=lr)
+
+    step = 0
+    for epoch in range(1, epochs + 1):
+        for start in range(0, len(paths), batch_size):
+            batch = torch.cat([model.preprocess(crop(model.open_image(p)), image_size)
+                               for p in paths[start:start + batch_size]])
+            output = net(batch)
+            output_features = model.get_features(output)
+            with torch.no_grad():
+                content_features = model.get_features(batch)
+
+            content_loss = torch.mean((output_features['conv4_2'] - content_features['conv4_2'])**2)
+            style_loss = 0
+            for layer in model.style_weights:
+                feature = output_features[layer]
+                _, d, h, w = feature.shape
+                layer_loss = torch.mean((model.gram_matrix(feature) - style_grams[layer])**2)
+                style_loss += model.style_weights[layer] * layer_loss / (d * h * w)**2
+            total_loss = content_weight * content_loss + style_weight * style_loss
+
+            optimizer.zero_grad()
+            total_loss.backward()
+            optimizer.step()
+
+            step += 1
+            if step % log_interval == 0:
+                logger.info(f"Epoch {epoch}/{epochs} step {step} - Loss: {total_loss.item():.4f}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(style_path))[0]
+    output_path = os.path.join(output_dir, f'{name}.pth')
+    torch.save({
+        'state_dict': net.cpu().state_dict(),
+        'style_name': os.path.basename(style_path),
+        'style_sha256': file_sha256(style_path),
+        'image_size': image_size,
+        'trained_at': datetime.now().isoformat()
+    }, output_path)
+    logger.info(f"Saved fast style model to {output_path}")
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train feed-forward style networks for the stock styles")
+    parser.add_argument('--style', action='append', required=True, help="style image (repeatable)")
+    parser.add_argument('--dataset', required=True, help="directory of content training images")
+    parser.add_argument('--output-dir', default='fast_models')
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--image-size', type=int, default=256)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--content-weight', type=float, default=1e5)
+    parser.add_argument('--style-weight', type=float, default=1e10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    from model import StyleTransferModel
+    model = StyleTransferModel()
+    for style_path in args.style:
+        train(model, style_path, args.dataset, output_dir=args.output_dir, epochs=args.epochs,
+              batch_size=args.batch_size, image_size=args.image_size, lr=args.lr,
+              content_weight=args.content_weight, style_weight=args.style_weight)
+
+
+if __name__ == '__main__':
+    main()
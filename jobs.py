@@ -0,0 +1,270 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional
+
+
+class Job:
+    """A unit of background work tracked by the JobManager."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, job_id: str, owner: Optional[str] = None, params: Optional[dict] = None):
+        self.id = job_id
+        self.owner = owner
+        self.params = params or {}
+        self.status = Job.PENDING
+        self.progress = {'current': 0, 'total': 0, 'percentage': 0}
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in (Job.COMPLETED, Job.FAILED, Job.CANCELLED)
+
+    @property
+    def cancel_requested(self):
+        """Polled by the running work between steps; it stops cooperatively."""
+        return self.cancel_event.is_set()
+
+    def to_dict(self):
+        """Return a JSON-serialisable view of the job."""
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class JobManager:
+    """Run jobs on a pool of worker threads and keep track of their state."""
+
+    def __init__(self, max_workers: int = 2, max_finished: int = 1000):
+        self.logger = logging.getLogger(__name__)
+        self.max_workers = max_workers
+        self.max_finished = max_finished
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transfer-worker')
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def create(self, owner: Optional[str] = None, params: Optional[dict] = None,
+               job_id: Optional[str] = None) -> Job:
+        """Register a pending job without scheduling it."""
+        job = Job(job_id or uuid.uuid4().hex, owner=owner, params=params)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        return job
+
+    def submit(self, func: Callable, *args, owner: Optional[str] = None, params: Optional[dict] = None,
+               job_id: Optional[str] = None, **kwargs) -> Job:
+        """Queue func(job, *args, **kwargs) for execution and return the job right away."""
+        job = self.create(owner=owner, params=params, job_id=job_id)
+        self.executor.submit(self._run, job, func, args, kwargs)
+        self.logger.info(f"Queued job {job.id}. Queue depth: {self.queue_depth()}")
+        return job
+
+    def run_now(self, func: Callable, *args, owner: Optional[str] = None, params: Optional[dict] = None,
+                **kwargs) -> Job:
+        """Run func(job, *args, **kwargs) in the calling thread for work too cheap to queue."""
+        job = self.create(owner=owner, params=params)
+        self._run(job, func, args, kwargs)
+        return job
+
+    def run_group(self, func: Callable, jobs: List[Job], items: List, on_done: Optional[Callable] = None):
+        """Run func(jobs, items) on a worker; it returns one result or exception per job."""
+        future = self.executor.submit(self._run_group, jobs, func, items)
+        if on_done:
+            future.add_done_callback(lambda _: on_done())
+        return future
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def unfinished(self) -> List[Job]:
+        with self.lock:
+            return [job for job in self.jobs.values() if not job.done]
+
+    def cancel(self, job: Job) -> Optional[str]:
+        """Ask a job to stop; a pending job is cancelled right away.
+
+        Returns the status the job had, or None if it had already finished.
+        """
+        with self.lock:
+            if job.done:
+                return None
+            previous_status = job.status
+            job.cancel_event.set()
+            if job.status == Job.PENDING:
+                job.status = Job.CANCELLED
+                job.finished_at = datetime.now().isoformat()
+        self.logger.info(f"Job {job.id} cancellation requested")
+        return previous_status
+
+    def queue_depth(self) -> int:
+        """Number of jobs that have not started yet."""
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status == Job.PENDING)
+
+    def active_count(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status == Job.RUNNING)
+
+    def shutdown(self, wait: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _start(self, job: Job) -> bool:
+        """Mark a job running unless it was cancelled while it waited."""
+        with self.lock:
+            if job.cancel_requested:
+                return False
+            job.status = Job.RUNNING
+            job.started_at = datetime.now().isoformat()
+            return True
+
+    def _fail(self, job: Job, error: Exception):
+        job.error = str(error)
+        if job.cancel_requested:
+            job.status = Job.CANCELLED
+            self.logger.info(f"Job {job.id} cancelled")
+        else:
+            job.status = Job.FAILED
+            self.logger.error(f"Job {job.id} failed: {str(error)}")
+
+    def _run(self, job: Job, func: Callable, args: tuple, kwargs: dict):
+        if not self._start(job):
+            return
+        self.logger.info(f"Job {job.id} started")
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = Job.COMPLETED
+            self.logger.info(f"Job {job.id} completed")
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            job.finished_at = datetime.now().isoformat()
+
+    def _run_group(self, jobs: List[Job], func: Callable, items: List):
+        # Jobs cancelled while they waited are left out of the group
+        started = [(job, item) for job, item in zip(jobs, items) if self._start(job)]
+        if not started:
+            return
+        jobs = [job for job, _ in started]
+        items = [item for _, item in started]
+        self.logger.info(f"Running {len(jobs)} job(s) together: {', '.join(job.id for job in jobs)}")
+        try:
+            results = func(jobs, items)
+        except Exception as e:
+            results = [e] * len(jobs)
+        for job, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                self._fail(job, result)
+            else:
+                job.result = result
+                job.status = Job.COMPLETED
+                self.logger.info(f"Job {job.id} completed")
+            job.finished_at = datetime.now().isoformat()
+
+    def _prune(self):
+        """Forget the oldest finished jobs once more than max_finished are kept."""
+        finished = [job for job in self.jobs.values() if job.done]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+
+
+class BatchScheduler:
+    """Group pending jobs that share a batch key and run each group in one call.
+
+    A dispatcher thread waits for a free worker, then takes up to max_batch_size
+    jobs with the key of the oldest pending job. When the pool is idle it waits
+    batch_window seconds so that jobs submitted together can share a batch. A key
+    of None never batches.
+    """
+
+    UNBATCHED = object()
+
+    def __init__(self, job_manager: JobManager, run_batch: Callable, max_batch_size: int = 4,
+                 batch_window: float = 0.2):
+        self.logger = logging.getLogger(__name__)
+        self.job_manager = job_manager
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.pending: 'OrderedDict[Hashable, List[tuple]]' = OrderedDict()
+        self.slots = threading.Semaphore(job_manager.max_workers)
+        self.condition = threading.Condition()
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch, name='batch-dispatcher', daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, key: Optional[Hashable], item, owner: Optional[str] = None,
+               params: Optional[dict] = None) -> Job:
+        """Queue an item under a batch key and return its job right away."""
+        job = self.job_manager.create(owner=owner, params=params)
+        if key is None:
+            key = (self.UNBATCHED, job.id)
+        with self.condition:
+            self.pending.setdefault(key, []).append((job, item, time.monotonic()))
+            self.condition.notify()
+        self.logger.info(f"Queued job {job.id}. Queue depth: {self.job_manager.queue_depth()}")
+        return job
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def _next_group(self):
+        """Pop the next group to run, waiting for the batch window if needed."""
+        with self.condition:
+            while self.running:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                key, entries = next(iter(self.pending.items()))
+                remaining = entries[0][2] + self.batch_window - time.monotonic()
+                unbatched = isinstance(key, tuple) and key[0] is self.UNBATCHED
+                if len(entries) < self.max_batch_size and remaining > 0 and not unbatched:
+                    self.condition.wait(remaining)
+                    continue
+                group = entries[:self.max_batch_size]
+                if len(entries) > len(group):
+                    self.pending[key] = entries[len(group):]
+                else:
+                    del self.pending[key]
+                return group
+            return None
+
+    def _dispatch(self):
+        while True:
+            self.slots.acquire()
+            group = self._next_group()
+            if group is None:
+                self.slots.release()
+                return
+            jobs = [job for job, _, _ in group]
+            items = [item for _, item, _ in group]
+            try:
+                self.job_manager.run_group(self.run_batch, jobs, items, on_done=self.slots.release)
+            except RuntimeError as e:
+                # The executor has been shut down
+                self.logger.error(f"Could not schedule {len(jobs)} job(s): {str(e)}")
+                self.slots.release()
+                return
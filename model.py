@@ -1,28 +1,154 @@
+import argparse
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import transforms, models
+from torchvision.models.vgg import cfgs as vgg_cfgs, make_layers
 from PIL import Image
 import numpy as np
 import requests
 from io import BytesIO
 import logging
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import json
+from style_cache import StyleFeatureCache
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent first starts may each download the weights
+    fcntl = None
+
+class TransferCancelled(Exception):
+    """Raised out of an optimisation loop when its should_stop callback returns True."""
+
+
+class ProgressReporter:
+    """Throttle progress updates from an optimisation loop.
+
+    An update is due on the first and last step, once every_steps steps have passed,
+    or once every_seconds have elapsed since the previous update (either trigger can
+    be disabled with None/0). The loss is only read when an update is due, so
+    in-between steps never force a device sync for it.
+    """
+
+    def __init__(self, report, total, every_steps=25, every_seconds=1.0):
+        self.report = report
+        self.total = total
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.last_step = 0
+        self.last_time = time.monotonic()
+
+    def due(self, step):
+        if step <= 1 or step >= self.total:
+            return True
+        if self.every_steps and step - self.last_step >= self.every_steps:
+            return True
+        return bool(self.every_seconds) and time.monotonic() - self.last_time >= self.every_seconds
+
+    def step(self, step, loss=None):
+        """Report step if an update is due; loss may be a tensor or a callable returning one."""
+        if not self.due(step):
+            return False
+        self.last_step = step
+        self.last_time = time.monotonic()
+        if callable(loss):
+            loss = loss()
+        self.report(step, self.total, float(loss) if loss is not None else None)
+        return True
+
+class PreviewStreamer:
+    """Send small encoded snapshots of the target while it is being optimised.
+
+    A frame is due every every_steps steps or every_seconds seconds. The optimisation
+    loop only pays for a copy of the target; conversion, downscaling and encoding run
+    on a background thread. A due frame is skipped while the previous one is still
+    encoding, and the interval grows to at least max_share of the time between frames
+    so the encoder stays within a few percent of the run.
+    """
+
+    def __init__(self, send, to_image, every_steps=50, every_seconds=2.0, max_size=128,
+                 image_format='JPEG', quality=70, max_share=0.05):
+        self.send = send
+        self.to_image = to_image
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.max_size = max_size
+        self.image_format = image_format
+        self.quality = quality
+        self.max_share = max_share
+        self.offset = 0
+        self.last_step = 0
+        self.last_time = time.monotonic()
+        self.encode_seconds = 0.0
+        self.pending = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preview-encoder')
+
+    def due(self, step):
+        if self.pending is not None and not self.pending.done():
+            return False
+        elapsed = time.monotonic() - self.last_time
+        if elapsed < self.encode_seconds / self.max_share:
+            return False
+        if self.every_steps and step - self.last_step >= self.every_steps:
+            return True
+        return bool(self.every_seconds) and elapsed >= self.every_seconds
+
+    def step(self, step, target):
+        """Queue a frame of target if one is due; step is relative to the current offset."""
+        step += self.offset
+        if not self.due(step):
+            return False
+        self.last_step = step
+        self.last_time = time.monotonic()
+        snapshot = target.detach().to('cpu', copy=True)
+        self.pending = self.executor.submit(self._encode, step, snapshot)
+        return True
+
+    def close(self):
+        """Wait for the frame being encoded so none arrives after the final result."""
+        self.executor.shutdown(wait=True)
+
+    def _encode(self, step, snapshot):
+        started = time.monotonic()
+        try:
+            image = self.to_image(snapshot)
+            image.thumbnail((self.max_size, self.max_size))
+            buffer = BytesIO()
+            image.save(buffer, format=self.image_format, quality=self.quality)
+            self.send(step, buffer.getvalue())
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Error encoding preview frame: {str(e)}")
+        finally:
+            self.encode_seconds = time.monotonic() - started
 
 class StyleTransferModel:
-    def __init__(self):
+    OPTIMIZERS = ('adam', 'lbfgs')
+
+    def __init__(self, style_cache=None, weights_path=os.path.join('weights', 'vgg19_features.pt'),
+                 allow_download=True, lazy=False):
+        """Set up the model; with lazy=True the VGG weights are loaded on first use or load().
+
+        weights_path is a local file holding only the VGG feature layers the losses use.
+        When it is missing and allow_download is set, the torchvision weights are
+        downloaded once and the needed layers are saved there for later starts.
+        """
         # Get the root logger
         self.logger = logging.getLogger(__name__)
         
         # Initialize the model
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.vgg = models.vgg19(pretrained=True).features.to(self.device).eval()
-        
-        # Freeze all VGG parameters
-        for param in self.vgg.parameters():
-            param.requires_grad_(False)
+        self.weights_path = weights_path
+        self.allow_download = allow_download
+        self._vgg = None
+        self._vgg_lock = threading.Lock()
+        self.weights_mapped = False
         
         # Style and content layers
         self.layers = {
@@ -48,151 +174,972 @@ class StyleTransferModel:
         self.style_weight = 1e3  # beta
         
         # Image transformation
-        self.transform = transforms.Compose([
-            transforms.Resize(128),  # max_size=128
-            transforms.ToTensor(),
-            transforms.Normalize((0.485, 0.456, 0.406),
-                               (0.229, 0.224, 0.225))
-        ])
+        self.image_size = 128
+        self.transform = self.build_transform(self.image_size)  # max_size=128
         
         # Progress tracking
         self.current_progress = 0
         self.total_steps = 0
         self.progress_callback = None
+        self.progress_every_steps = 25
+        self.progress_every_seconds = 1.0
+        
+        # Live preview frames (see PreviewStreamer)
+        self.preview_every_steps = 50
+        self.preview_every_seconds = 2.0
+        self.preview_size = 128
+        self.preview_format = 'JPEG'
+        
+        # How often (in steps) the early-stopping rule reads back the loss
+        self.convergence_check_every = 10
+        
+        # Opt-in execution modes (see configure)
+        self.channels_last = False
+        self.autocast_dtype = None
+        self.compiled = False
+        self._extract = self.extract_features
+        
+        # Cache of style Gram matrices keyed by style pixels and resolution
+        self.style_cache = style_cache if style_cache is not None else StyleFeatureCache()
+        
+        if not lazy:
+            self.load()
+
+    @property
+    def vgg(self):
+        """The frozen VGG feature extractor, loaded on first access."""
+        if self._vgg is None:
+            self.load()
+        return self._vgg
+
+    @property
+    def ready(self):
+        return self._vgg is not None
+
+    def load(self):
+        """Load the VGG feature layers if they are not loaded yet; safe to call from any thread."""
+        with self._vgg_lock:
+            if self._vgg is not None:
+                return self._vgg
+            started = time.monotonic()
+            
+            # Keep only the layers up to the deepest one used by a loss; the rest
+            # of the feature stack would run on every step for nothing
+            depth = self.feature_depth(self.layers)
+            if self.weights_path and not os.path.exists(self.weights_path) and self.allow_download:
+                self.download_vgg_weights(self.weights_path, depth)
+            if self.weights_path and os.path.exists(self.weights_path):
+                # Mapped read-only from the page cache, so every process that loads the
+                # same file shares one physical copy of the weights
+                vgg = self.load_vgg_weights(self.weights_path, depth)
+                self.weights_mapped = True
+            elif self.allow_download:
+                vgg = models.vgg19(pretrained=True).features[:depth]
+            else:
+                raise FileNotFoundError(f"VGG weights not found at {self.weights_path} and downloads are disabled")
+            vgg = vgg.to(self.device).eval()
+            if self.channels_last:
+                vgg = vgg.to(memory_format=torch.channels_last)
+            
+            # Freeze all VGG parameters
+            for param in vgg.parameters():
+                param.requires_grad_(False)
+            
+            self._vgg = vgg
+            self.logger.info(f"VGG features loaded in {time.monotonic() - started:.2f}s")
+            return vgg
+
+    def configure(self, channels_last=False, bf16=False, compile=False, num_threads=None):
+        """Choose how the VGG forward/backward runs; every mode is off by default.
+
+        channels_last stores images and weights NHWC, which oneDNN convolutions prefer
+        on CPU. bf16 runs the feature extractor under bfloat16 autocast (only when the
+        CPU has native bf16 support, or on CUDA); losses stay in float32. compile wraps
+        the extractor in torch.compile; call warm_up() to pay for compilation up front.
+        num_threads sets the intra-op thread count of this process.
+        """
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.channels_last = channels_last
+        if self._vgg is not None:
+            memory_format = torch.channels_last if channels_last else torch.contiguous_format
+            self._vgg = self._vgg.to(memory_format=memory_format)
+        self.autocast_dtype = None
+        if bf16:
+            if self.bf16_supported():
+                self.autocast_dtype = torch.bfloat16
+            else:
+                self.logger.warning("bfloat16 requested but not supported natively here; using float32")
+        self.compiled = compile
+        self._extract = torch.compile(self.extract_features) if compile else self.extract_features
+        self.logger.info(f"Execution mode: channels_last={channels_last}, bf16={self.autocast_dtype is not None}, "
+                         f"compile={compile}, threads={torch.get_num_threads()}")
+
+    def bf16_supported(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.is_bf16_supported()
+        is_supported = getattr(torch.cpu, '_is_avx512_bf16_supported', None)
+        return bool(is_supported and is_supported())
+
+    def warm_up(self, size=None):
+        """Run the kinds of forward pass a transfer makes so lazy setup (and compilation) happens now.
+
+        Style and content features are taken without grad mode, the target's with a
+        backward pass; a compiled extractor specialises on each of these.
+        """
+        size = size or self.image_size
+        image = torch.rand(1, 3, size, size, device=self.device)
+        with torch.no_grad():
+            self.get_features(image)
+        target = image.clone().requires_grad_(True)
+        features = self.get_features(target)
+        sum(feature.mean() for feature in features.values()).backward()
+
+    @staticmethod
+    def load_vgg_weights(path, depth):
+        """VGG19 feature layers [:depth] with their weights memory-mapped from a local file."""
+        # Built on the meta device so no memory is allocated or initialised for weights
+        # that load_state_dict then replaces with the mapped tensors
+        with torch.device('meta'):
+            vgg = make_layers(vgg_cfgs['E'])[:depth]
+        state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        vgg.load_state_dict(state_dict, assign=True)
+        return vgg
+
+    def download_vgg_weights(self, path, depth):
+        """Download the torchvision weights once and export the first depth feature layers to path.
+
+        A lock file next to path makes concurrent server workers wait for a single
+        download and then map the exported file like everyone else.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f'{path}.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                return
+            vgg = models.vgg19(pretrained=True).features[:depth]
+            self.save_vgg_weights(vgg, path)
+            self.logger.info(f"Saved VGG feature weights to {path}")
+
+    @staticmethod
+    def save_vgg_weights(vgg, path):
+        """Write the feature layers' state dict atomically."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.save(vgg.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
 
     def set_progress_callback(self, callback):
         """Set a callback function for progress updates."""
         self.progress_callback = callback
 
-    def update_progress(self, current, total, loss=None):
+    def update_progress(self, current, total, loss=None, callback=None):
         """Update progress and log information."""
         self.current_progress = current
         self.total_steps = total
         
-        if self.progress_callback:
-            self.progress_callback(current, total, loss)
+        callback = callback or self.progress_callback
+        if callback:
+            callback(current, total, loss)
         
         if loss is not None:
             self.logger.info(f"Step {current}/{total} - Loss: {loss:.4f}")
 
-    def load_image(self, img_path, max_size=128, shape=None):
-        """Load in and transform an image."""
-        try:
-            if "http" in img_path:
-                response = requests.get(img_path)
+    def make_reporter(self, total, callback=None):
+        """ProgressReporter that forwards due updates to update_progress."""
+        return ProgressReporter(
+            lambda current, total, loss: self.update_progress(current, total, loss, callback=callback),
+            total, every_steps=self.progress_every_steps, every_seconds=self.progress_every_seconds)
+
+    def make_previewer(self, send):
+        """PreviewStreamer that calls send(step, frame_bytes) with encoded snapshots."""
+        return PreviewStreamer(send, self.tensor_to_image, every_steps=self.preview_every_steps,
+                               every_seconds=self.preview_every_seconds, max_size=self.preview_size,
+                               image_format=self.preview_format)
+
+    def open_image(self, img_path):
+        """Open an image from a URL or a file as an RGB PIL image."""
+        if "http" in img_path:
+            response = requests.get(img_path)
+            with metrics.phase('decode'):
                 image = Image.open(BytesIO(response.content)).convert('RGB')
-                self.logger.info(f"Loaded image from URL: {img_path}")
-            else:
+            self.logger.info(f"Loaded image from URL: {img_path}")
+        else:
+            with metrics.phase('decode'):
                 image = Image.open(img_path).convert('RGB')
-                self.logger.info(f"Loaded image from file: {img_path}")
+            self.logger.info(f"Loaded image from file: {img_path}")
+        return image
 
-            # Resize large images
-            if max(image.size) > max_size:
-                size = max_size
-            else:
-                size = max(image.size)
+    @staticmethod
+    def build_transform(size):
+        """Resize (shorter edge, or an exact (h, w) shape), convert and normalise."""
+        return transforms.Compose([
+            transforms.Resize(size),
+            transforms.ToTensor(),
+            transforms.Normalize((0.485, 0.456, 0.406),
+                               (0.229, 0.224, 0.225))
+        ])
 
+    def preprocess(self, image, size=None):
+        """Transform a PIL image into a normalised batch tensor on the model device."""
+        transform = self.transform if size is None or size == self.image_size else self.build_transform(size)
+        image = transform(image)[:3,:,:].unsqueeze(0)
+        return image.to(self.device)
+
+    def load_image(self, img_path, max_size=None, shape=None):
+        """Load in and transform an image.
+
+        The shorter edge is resized to max_size (default self.image_size); an explicit
+        (h, w) shape takes precedence.
+        """
+        try:
+            image = self.open_image(img_path)
+
+            size = max_size or self.image_size
             if shape is not None:
-                size = shape
+                size = tuple(shape)
 
-            image = self.transform(image)[:3,:,:].unsqueeze(0)
-            return image.to(self.device)
+            return self.preprocess(image, size)
         except Exception as e:
             self.logger.error(f"Error loading image: {str(e)}")
             raise
 
+    @staticmethod
+    def feature_depth(layers):
+        """Number of VGG modules a layers mapping needs.
+
+        That is through the deepest named conv and the ReLU after it: the ReLUs run
+        in place, so every captured conv output is rectified, as in the full stack.
+        """
+        return max(int(name) for name in layers) + 2
+
     def get_features(self, image, layers=None):
-        """Run an image forward through a model and get the features for a set of layers."""
+        """Run an image forward through a model and get the features for a set of layers.
+
+        The forward pass stops at the deepest requested layer and only the requested
+        activations are returned; intermediate outputs are released as soon as the
+        next layer has consumed them. Features come back as float32 in every mode.
+        """
         if layers is None:
             layers = self.layers
+        vgg = self.vgg
+        if self.channels_last:
+            image = image.contiguous(memory_format=torch.channels_last)
+        if self.autocast_dtype is None:
+            return self._extract(vgg, image, layers)
+        with torch.autocast(self.device.type, dtype=self.autocast_dtype):
+            features = self._extract(vgg, image, layers)
+        return {name: feature.float() for name, feature in features.items()}
 
+    @staticmethod
+    def extract_features(vgg, image, layers):
+        # Stop after the in-place ReLU that follows the deepest captured layer
+        last = StyleTransferModel.feature_depth(layers) - 1
         features = {}
         x = image
-        for name, layer in self.vgg._modules.items():
+        for name, layer in vgg._modules.items():
             x = layer(x)
             if name in layers:
                 features[layers[name]] = x
+            if int(name) >= last:
+                break
 
         return features
 
     def gram_matrix(self, tensor):
-        """Calculate the Gram Matrix of a given tensor."""
-        _, d, h, w = tensor.size()
-        tensor = tensor.view(d, h * w)
-        gram = torch.mm(tensor, tensor.t())
-        return gram
-
-    def transfer_style(self, content_path, style_path, num_steps=500):
-        """Perform style transfer between content and style images."""
+        """Calculate the Gram Matrix of a given tensor.
+
+        A batch of one gives a (d, d) matrix as before; larger batches give one
+        Gram per sample, shaped (b, d, d).
+        """
+        b, d, h, w = tensor.size()
+        if b == 1:
+            tensor = tensor.reshape(d, h * w)
+            return torch.mm(tensor, tensor.t())
+        tensor = tensor.reshape(b, d, h * w)
+        return torch.bmm(tensor, tensor.transpose(1, 2))
+
+    def open_style(self, style):
+        """Decode a style argument once: a path/URL, or a list of (path, weight) pairs to blend."""
+        if isinstance(style, (list, tuple)):
+            return [(item if isinstance(item, Image.Image) else self.open_image(item), weight)
+                    for item, weight in style]
+        return style if isinstance(style, Image.Image) else self.open_image(style)
+
+    def blend_style_grams(self, styles, size=None):
+        """Weighted average of the Gram matrices of several styles, per layer.
+
+        Each style's Grams come from the cache like a single style's, so blending stock
+        styles costs one weighted sum per layer; the optimisation itself is unchanged.
+        """
+        if not styles:
+            raise ValueError("At least one style is needed to blend")
+        if any(weight < 0 for _, weight in styles) or sum(weight for _, weight in styles) <= 0:
+            raise ValueError("Style weights must be non-negative and add up to more than zero")
+        total = sum(weight for _, weight in styles)
+        blended = {}
+        for style, weight in styles:
+            for layer, gram in self.get_style_grams(style, size).items():
+                contribution = gram * (weight / total)
+                blended[layer] = blended[layer] + contribution if layer in blended else contribution
+        return blended
+
+    def get_style_grams(self, style, size=None):
+        """Return the per-layer style Gram matrices, computing them only on a cache miss.
+
+        style may be a path/URL or an already decoded PIL image, or a list of
+        (style, weight) pairs, which are blended (see blend_style_grams); size is the
+        working resolution (default self.image_size).
+        """
+        size = size or self.image_size
+        if isinstance(style, (list, tuple)):
+            return self.blend_style_grams(style, size)
+        image = style if isinstance(style, Image.Image) else self.open_image(style)
+        key = self.style_cache.make_key(image, size)
+        style_grams = self.style_cache.get(key, device=self.device)
+        if style_grams is not None:
+            self.logger.info(f"Style Gram cache hit at {size}px")
+            return style_grams
+
+        with torch.no_grad(), metrics.phase('style_features'):
+            style_features = self.get_features(self.preprocess(image, size))
+            style_grams = {layer: self.gram_matrix(style_features[layer])
+                           for layer in self.style_weights}
+        self.style_cache.put(key, style_grams)
+        return style_grams
+
+    def compute_loss(self, target, content_features, style_grams, per_sample=False):
+        """Weighted content plus style loss of a target image.
+
+        With per_sample=True a batch of targets gives a (b,) tensor of independent
+        losses; style_grams may then hold one stacked (b, d, d) Gram per sample.
+        """
+        # Get target features
+        target_features = self.get_features(target)
+        
+        # Calculate content loss
+        content_diff = (target_features['conv4_2'] - content_features['conv4_2'])**2
+        content_loss = content_diff.mean(dim=(1, 2, 3)) if per_sample else torch.mean(content_diff)
+        
+        # Calculate style loss
+        style_loss = 0
+        for layer in self.style_weights:
+            target_feature = target_features[layer]
+            target_gram = self.gram_matrix(target_feature)
+            _, d, h, w = target_feature.shape
+            style_gram = style_grams[layer]
+            style_diff = (target_gram - style_gram)**2
+            layer_style_loss = self.style_weights[layer] * (
+                style_diff.mean(dim=(-2, -1)) if per_sample else torch.mean(style_diff))
+            style_loss += layer_style_loss / (d * h * w)
+        
+        # Calculate total loss
+        return self.content_weight * content_loss + self.style_weight * style_loss
+
+    def has_converged(self, losses, window, tolerance):
+        """True once the loss improved by less than tolerance (relative) over the last window steps.
+
+        losses may hold floats or scalar tensors; only the two compared entries are read.
+        """
+        if tolerance is None or window is None or len(losses) <= window:
+            return False
+        previous, latest = float(losses[-window - 1]), float(losses[-1])
+        if previous == 0:
+            return True
+        return (previous - latest) / abs(previous) < tolerance
+
+    @staticmethod
+    def check_stop(should_stop, deadline):
+        """Raise TransferCancelled if should_stop() says so; True once deadline (time.monotonic()) has passed."""
+        if should_stop and should_stop():
+            raise TransferCancelled("Style transfer cancelled")
+        return deadline is not None and time.monotonic() >= deadline
+
+    @staticmethod
+    def record_step(started, forward_done, backward_done):
+        """Record the forward, backward and optimizer phases of one step from perf_counter marks."""
+        finished = time.perf_counter()
+        metrics.observe_phase('forward', forward_done - started)
+        metrics.observe_phase('backward', backward_done - forward_done)
+        metrics.observe_phase('optimizer_step', finished - backward_done)
+
+    def optimize(self, target, content_features, style_grams, num_steps=500,
+                 optimizer='adam', tolerance=None, window=50, progress_callback=None, preview=None,
+                 should_stop=None, deadline=None):
+        """Optimise target in place and return a summary of the run.
+
+        optimizer is 'adam' (the original fixed-step loop) or 'lbfgs'. num_steps caps
+        the number of loss evaluations; with a tolerance, the run also stops once the
+        relative loss improvement over the last window evaluations drops below it.
+        preview is an optional PreviewStreamer fed with the target after each update.
+
+        should_stop() is polled between steps and cancels the run with TransferCancelled.
+        Once deadline (a time.monotonic() value) passes, the run stops and target is set
+        to the lowest-loss image evaluated so far; L-BFGS checks it between its inner runs.
+        """
+        if optimizer not in self.OPTIMIZERS:
+            raise ValueError(f"Unknown optimizer '{optimizer}', expected one of {self.OPTIMIZERS}")
+
+        # Losses are kept as detached tensors and only read when reported or checked
+        losses = []
+        deadline_reached = False
+        reporter = self.make_reporter(num_steps, progress_callback)
+        
+        # Neither optimizer lowers the loss on every step, so a run that may be cut
+        # short by its deadline keeps a copy of the best image it has evaluated
+        best = {'loss': None, 'target': torch.empty_like(target.detach())} if deadline is not None else None
+        
+        def keep_best(loss):
+            if best is not None and (best['loss'] is None or float(loss) < best['loss']):
+                best['loss'] = float(loss)
+                best['target'].copy_(target.detach())
+        
+        if optimizer == 'adam':
+            opt = optim.Adam([target], lr=0.003)
+            for ii in range(1, num_steps + 1):
+                if self.check_stop(should_stop, deadline):
+                    deadline_reached = True
+                    break
+                started = time.perf_counter()
+                total_loss = self.compute_loss(target, content_features, style_grams)
+                forward_done = time.perf_counter()
+                
+                # Update target image; the loss belongs to the target before this update
+                opt.zero_grad()
+                total_loss.backward()
+                backward_done = time.perf_counter()
+                keep_best(total_loss.detach())
+                opt.step()
+                
+                # Clamp the values
+                target.data.clamp_(0, 1)
+                self.record_step(started, forward_done, backward_done)
+                
+                losses.append(total_loss.detach())
+                reporter.step(ii, total_loss.detach())
+                if preview:
+                    preview.step(ii, target)
+                if ii % self.convergence_check_every == 0 and self.has_converged(losses, window, tolerance):
+                    break
+        else:
+            opt = optim.LBFGS([target], lr=1, max_iter=20, history_size=50)
+            
+            # Time inside the closure is forward/backward; the rest of opt.step is the optimizer
+            closure_seconds = [0.0]
+            first_evaluation = [True]
+            
+            def closure():
+                # Only cancellation is checked here; stopping mid line search would leave no usable step
+                self.check_stop(should_stop, None)
+                started = time.perf_counter()
+                opt.zero_grad()
+                total_loss = self.compute_loss(target, content_features, style_grams)
+                forward_done = time.perf_counter()
+                total_loss.backward()
+                backward_done = time.perf_counter()
+                metrics.observe_phase('forward', forward_done - started)
+                metrics.observe_phase('backward', backward_done - forward_done)
+                closure_seconds[0] += backward_done - started
+                # Later evaluations within a step are line search points, not results
+                if first_evaluation[0]:
+                    keep_best(total_loss.detach())
+                    first_evaluation[0] = False
+                losses.append(total_loss.detach())
+                reporter.step(len(losses), total_loss.detach())
+                return total_loss
+            
+            while len(losses) < num_steps:
+                if self.check_stop(should_stop, deadline):
+                    deadline_reached = True
+                    break
+                evaluations = len(losses)
+                opt.param_groups[0]['max_iter'] = min(20, num_steps - evaluations)
+                started = time.perf_counter()
+                closure_seconds[0] = 0.0
+                first_evaluation[0] = True
+                opt.step(closure)
+                target.data.clamp_(0, 1)
+                metrics.observe_phase('optimizer_step', time.perf_counter() - started - closure_seconds[0])
+                if preview:
+                    preview.step(len(losses), target)
+                
+                # A single evaluation means L-BFGS found nothing left to improve
+                if len(losses) - evaluations <= 1 and opt.param_groups[0]['max_iter'] > 1:
+                    break
+                if self.has_converged(losses, window, tolerance):
+                    break
+
+        info = {
+            'optimizer': optimizer,
+            'steps': len(losses),
+            'max_steps': num_steps,
+            'final_loss': float(losses[-1]) if losses else None,
+            'stopped_early': len(losses) < num_steps
+        }
+        if deadline_reached:
+            info['deadline_reached'] = True
+            # The last update has not been evaluated yet; one forward pass settles it
+            if losses:
+                with torch.no_grad():
+                    keep_best(self.compute_loss(target, content_features, style_grams))
+                target.data.copy_(best['target'])
+                info['final_loss'] = best['loss']
+        return info
+
+    def tensor_to_image(self, tensor):
+        """Convert a normalised image tensor back into a PIL image."""
+        image = tensor.to("cpu").clone().detach()
+        image = image.numpy().squeeze()
+        image = image.transpose(1, 2, 0)
+        image = image * np.array((0.229, 0.224, 0.225)) + np.array((0.485, 0.456, 0.406))
+        image = image.clip(0, 1)
+        return Image.fromarray((image * 255).astype(np.uint8))
+
+    def transfer_style(self, content_path, style_path, num_steps=500, progress_callback=None,
+                       optimizer='adam', tolerance=None, window=50, return_info=False,
+                       levels=None, level_steps=None, preview_callback=None, should_stop=None,
+                       time_budget=None):
+        """Perform style transfer between content and style images.
+
+        progress_callback overrides the instance-wide callback for this call only,
+        which keeps concurrent transfers on a shared model from mixing updates.
+        With return_info=True an (image, info) tuple is returned, where info holds
+        the optimizer used, the steps actually run and the final loss.
+
+        levels turns on coarse-to-fine pyramid mode: a list of increasing working
+        resolutions (shorter edge in pixels). The result of each level is upsampled
+        as the starting image of the next, and level_steps gives the step budget per
+        level (by default num_steps at the first level and a tenth of it above).
+
+        preview_callback(step, frame_bytes) receives small encoded snapshots of the
+        image while it is optimised; see PreviewStreamer for how they are throttled.
+
+        style_path may also be a list of (style_path, weight) pairs; the target is then
+        optimised against the weighted average of their Gram matrices.
+
+        should_stop() is polled between steps; when it returns True the transfer raises
+        TransferCancelled. With a time_budget in seconds the optimisation stops at the
+        deadline and the image so far is returned (remaining pyramid levels only upsample
+        it), with info['deadline_reached'] set.
+        """
+        deadline = time.monotonic() + time_budget if time_budget else None
+        preview = self.make_previewer(preview_callback) if preview_callback else None
         try:
+            if levels is None:
+                levels = [self.image_size]
+                level_steps = [num_steps]
+            elif level_steps is None:
+                level_steps = [num_steps] + [max(1, num_steps // 10)] * (len(levels) - 1)
+            if len(levels) != len(level_steps):
+                raise ValueError("levels and level_steps must have the same length")
+            total_steps = sum(level_steps)
+
             self.logger.info(f"Starting style transfer process")
             self.logger.info(f"Content image: {content_path}")
             self.logger.info(f"Style image: {style_path}")
-            self.logger.info(f"Number of steps: {num_steps}")
+            self.logger.info(f"Number of steps: {total_steps} ({optimizer}, levels {levels})")
 
-            # Load images
-            content = self.load_image(content_path)
-            style = self.load_image(style_path)
-            
-            # Get content and style features
-            content_features = self.get_features(content)
-            style_features = self.get_features(style)
-            
-            # Calculate gram matrices for style features
-            style_grams = {layer: self.gram_matrix(style_features[layer]) 
-                          for layer in style_features}
-            
-            # Initialize target image
-            target = content.clone().requires_grad_(True).to(self.device)
-            
-            # Initialize optimizer
-            optimizer = optim.Adam([target], lr=0.003)
-            
-            # Run style transfer
-            for ii in range(1, num_steps + 1):
-                # Get target features
-                target_features = self.get_features(target)
+            # Decode both images once; each level resizes from the originals
+            content_image = self.open_image(content_path)
+            style_image = self.open_style(style_path)
+
+            target = None
+            level_infos = []
+            steps_done = 0
+            deadline_reached = False
+            for size, steps in zip(levels, level_steps):
+                # Load content image at this level's resolution
+                content = self.preprocess(content_image, size)
                 
-                # Calculate content loss
-                content_loss = torch.mean((target_features['conv4_2'] - 
-                                         content_features['conv4_2'])**2)
+                # Past the deadline the remaining levels only upsample the result
+                if deadline_reached:
+                    target = F.interpolate(target.detach(), size=content.shape[-2:],
+                                           mode='bilinear', align_corners=False)
+                    continue
                 
-                # Calculate style loss
-                style_loss = 0
-                for layer in self.style_weights:
-                    target_feature = target_features[layer]
-                    target_gram = self.gram_matrix(target_feature)
-                    _, d, h, w = target_feature.shape
-                    style_gram = style_grams[layer]
-                    layer_style_loss = self.style_weights[layer] * torch.mean(
-                        (target_gram - style_gram)**2)
-                    style_loss += layer_style_loss / (d * h * w)
+                # Get content features and the (possibly cached) style gram matrices
+                with torch.no_grad(), metrics.phase('content_features'):
+                    content_features = self.get_features(content)
+                style_grams = self.get_style_grams(style_image, size)
                 
-                # Calculate total loss
-                total_loss = self.content_weight * content_loss + self.style_weight * style_loss
+                # Initialize target image, from the previous level when there is one
+                if target is None:
+                    target = content.clone()
+                else:
+                    target = F.interpolate(target.detach(), size=content.shape[-2:],
+                                           mode='bilinear', align_corners=False)
+                target = target.requires_grad_(True).to(self.device)
                 
-                # Update target image
-                optimizer.zero_grad()
-                total_loss.backward()
-                optimizer.step()
+                # Report progress across the whole pyramid rather than per level
+                offset = steps_done
+                callback = progress_callback or self.progress_callback
+                level_callback = None
+                if callback:
+                    level_callback = lambda current, total, loss, offset=offset: callback(
+                        offset + current, total_steps, loss)
                 
-                # Clamp the values
-                target.data.clamp_(0, 1)
+                if preview:
+                    preview.offset = offset
                 
-                # Update progress every step
-                self.update_progress(ii, num_steps, total_loss.item())
+                # Run style transfer
+                info = self.optimize(target, content_features, style_grams, num_steps=steps,
+                                     optimizer=optimizer, tolerance=tolerance, window=window,
+                                     progress_callback=level_callback, preview=preview,
+                                     should_stop=should_stop, deadline=deadline)
+                info['size'] = size
+                level_infos.append(info)
+                steps_done += info['steps']
+                deadline_reached = info.get('deadline_reached', False)
             
             # Convert to PIL Image
-            image = target.to("cpu").clone().detach()
-            image = image.numpy().squeeze()
-            image = image.transpose(1, 2, 0)
-            image = image * np.array((0.229, 0.224, 0.225)) + np.array((0.485, 0.456, 0.406))
-            image = image.clip(0, 1)
-            image = Image.fromarray((image * 255).astype(np.uint8))
-            
-            self.logger.info("Style transfer completed successfully")
+            image = self.tensor_to_image(target)
+            
+            info = {
+                'optimizer': optimizer,
+                'steps': steps_done,
+                'max_steps': total_steps,
+                'final_loss': level_infos[-1]['final_loss'],
+                'stopped_early': steps_done < total_steps
+            }
+            if len(levels) > 1:
+                info['levels'] = level_infos
+            if deadline_reached:
+                info['deadline_reached'] = True
+            
+            self.logger.info(f"Style transfer completed successfully in {steps_done} steps")
+            if return_info:
+                return image, info
             return image
             
+        except TransferCancelled:
+            self.logger.info("Style transfer cancelled")
+            raise
         except Exception as e:
             self.logger.error(f"Error during style transfer: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
+        finally:
+            if preview:
+                preview.close()
+
+    def transfer_style_sequence(self, frames, style_path, num_steps=500, frame_steps=None, optimizer='adam',
+                                tolerance=None, window=50, size=None, warm_start=True):
+        """Stylize an iterable of PIL frames in order, yielding (image, info) for each.
+
+        The style Grams are computed once for the whole sequence. The first frame starts
+        from its content and runs num_steps like transfer_style; with warm_start each
+        later frame starts from the previous frame's result and runs at most frame_steps
+        (default a tenth of num_steps), which also keeps consecutive frames consistent.
+        Without warm_start every frame is a full, independent transfer.
+        """
+        size = size or self.image_size
+        if frame_steps is None:
+            frame_steps = max(1, num_steps // 10)
+        style_grams = self.get_style_grams(style_path, size)
+
+        previous = None
+        for index, frame in enumerate(frames):
+            content = self.preprocess(frame.convert('RGB'), size)
+            with torch.no_grad(), metrics.phase('content_features'):
+                content_features = self.get_features(content)
+
+            # Start from the previous result, resized if the frame shape changed
+            if previous is None or not warm_start:
+                target = content.clone()
+                steps = num_steps
+            else:
+                target = previous
+                if target.shape[-2:] != content.shape[-2:]:
+                    target = F.interpolate(target, size=content.shape[-2:], mode='bilinear', align_corners=False)
+                steps = frame_steps
+            target = target.requires_grad_(True).to(self.device)
+
+            info = self.optimize(target, content_features, style_grams, num_steps=steps,
+                                 optimizer=optimizer, tolerance=tolerance, window=window)
+            info['frame'] = index
+            info['warm_start'] = previous is not None and warm_start
+            previous = target.detach()
+            yield self.tensor_to_image(previous), info
+
+    @staticmethod
+    def tile_origins(length, tile_size, overlap):
+        """Start offsets of tiles covering length pixels, neighbours overlapping by at least overlap."""
+        if length <= tile_size:
+            return [0]
+        origins = list(range(0, length - tile_size, tile_size - overlap))
+        origins.append(length - tile_size)
+        return origins
+
+    @staticmethod
+    def blend_ramp(length, overlap, start, end):
+        """1-D blending weights for a tile: linear fades over overlap pixels on shared edges."""
+        ramp = torch.ones(length)
+        fade = min(overlap, length // 2)
+        if fade:
+            rising = torch.arange(1, fade + 1, dtype=torch.float32) / (fade + 1)
+            if start:
+                ramp[:fade] = rising
+            if end:
+                ramp[-fade:] = rising.flip(0)
+        return ramp
+
+    def transfer_style_tiled(self, content_path, style_path, size=None, tile_size=256, overlap=32,
+                             num_steps=500, workers=2, optimizer='adam', tolerance=None, window=50,
+                             progress_callback=None, return_info=False, should_stop=None, time_budget=None):
+        """Style a large image tile by tile against one set of style Gram matrices.
+
+        size is the output's shorter edge (default: the content image's own). Tiles of
+        tile_size pixels, overlapping by overlap, are optimised independently, up to
+        workers at a time, and feathered together across the overlaps. Peak memory thus
+        follows tile_size and workers rather than the image size. should_stop and
+        time_budget work as in transfer_style; tiles not reached by the deadline keep
+        their content.
+        """
+        deadline = time.monotonic() + time_budget if time_budget else None
+        if not 0 <= overlap < tile_size:
+            raise ValueError("overlap must be at least 0 and smaller than tile_size")
+        try:
+            content_image = self.open_image(content_path)
+            style_image = self.open_style(style_path)
+            size = size or min(content_image.size)
+            
+            # The full image stays on the CPU; only tiles being optimised go to the device
+            content = self.preprocess(content_image, size).cpu()
+            _, _, height, width = content.shape
+            
+            # Style statistics are computed once at the scale of a single tile
+            style_grams = self.get_style_grams(style_image, tile_size)
+            
+            rows = self.tile_origins(height, tile_size, overlap)
+            cols = self.tile_origins(width, tile_size, overlap)
+            tiles = [(top, left) for top in rows for left in cols]
+            total_steps = len(tiles) * num_steps
+            self.logger.info(f"Starting tiled style transfer: {width}x{height} in {len(tiles)} "
+                             f"tile(s) of {tile_size}px, overlap {overlap}px, {workers} worker(s)")
+            
+            # Progress is the sum of the steps every tile has run so far
+            callback = progress_callback or self.progress_callback
+            tile_steps = [0] * len(tiles)
+            lock = threading.Lock()
+            
+            def tile_callback(index):
+                def report(current, total, loss):
+                    with lock:
+                        tile_steps[index] = current
+                        done = sum(tile_steps)
+                    if callback:
+                        callback(done, total_steps, loss)
+                return report
+            
+            def run_tile(index, top, left):
+                tile = content[:, :, top:top + tile_size, left:left + tile_size].to(self.device)
+                with torch.no_grad(), metrics.phase('content_features'):
+                    content_features = self.get_features(tile)
+                target = tile.clone().requires_grad_(True)
+                info = self.optimize(target, content_features, style_grams, num_steps=num_steps,
+                                     optimizer=optimizer, tolerance=tolerance, window=window,
+                                     progress_callback=tile_callback(index), should_stop=should_stop,
+                                     deadline=deadline)
+                return top, left, target.detach().cpu(), info
+            
+            output = torch.zeros_like(content)
+            weights = torch.zeros(1, 1, height, width)
+            infos = []
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile-worker') as executor:
+                futures = [executor.submit(run_tile, index, top, left) for index, (top, left) in enumerate(tiles)]
+                for future in as_completed(futures):
+                    top, left, tile, info = future.result()
+                    _, _, tile_h, tile_w = tile.shape
+                    weight = torch.outer(
+                        self.blend_ramp(tile_h, overlap, top > 0, top + tile_h < height),
+                        self.blend_ramp(tile_w, overlap, left > 0, left + tile_w < width))
+                    output[:, :, top:top + tile_h, left:left + tile_w] += tile * weight
+                    weights[:, :, top:top + tile_h, left:left + tile_w] += weight
+                    infos.append(info)
+            
+            image = self.tensor_to_image(output / weights)
+            steps = sum(info['steps'] for info in infos)
+            info = {
+                'optimizer': optimizer,
+                'steps': steps,
+                'max_steps': total_steps,
+                'final_loss': sum(info['final_loss'] or 0 for info in infos) / len(infos),
+                'stopped_early': steps < total_steps,
+                'tiles': len(tiles),
+                'tile_size': tile_size,
+                'overlap': overlap,
+                'dimensions': {'width': width, 'height': height}
+            }
+            if any(tile_info.get('deadline_reached') for tile_info in infos):
+                info['deadline_reached'] = True
+            
+            self.logger.info(f"Tiled style transfer completed successfully in {steps} steps")
+            if return_info:
+                return image, info
+            return image
+            
+        except TransferCancelled:
+            self.logger.info("Tiled style transfer cancelled")
+            raise
+        except Exception as e:
+            self.logger.error(f"Error during tiled style transfer: {str(e)}")
+            raise
+
+    def transfer_style_batch(self, content_paths, style_paths, num_steps=500, tolerance=None,
+                             window=50, progress_callbacks=None, should_stops=None, time_budget=None):
+        """Run several same-shaped Adam transfers as one batch.
+
+        Every step does a single VGG forward and backward over the stacked targets,
+        with per-sample content and style losses, so each sample follows the same
+        trajectory it would alone. A sample that converges is snapshotted and keeps
+        riding along until the whole batch is done. Returns a list of (image, info).
+
+        should_stops holds one callback per sample: a cancelled sample is dropped like a
+        converged one and marked info['cancelled'], and TransferCancelled is raised once
+        every sample is cancelled. time_budget stops the whole batch at the deadline,
+        and each unfinished sample then gets the lowest-loss image it has evaluated.
+        """
+        deadline = time.monotonic() + time_budget if time_budget else None
+        try:
+            batch_size = len(content_paths)
+            progress_callbacks = progress_callbacks or [None] * batch_size
+            should_stops = should_stops or [None] * batch_size
+            self.logger.info(f"Starting batched style transfer of {batch_size} images")
+
+            # Load content images; they must share a working shape
+            contents = [self.load_image(path) for path in content_paths]
+            if len({tuple(content.shape) for content in contents}) != 1:
+                raise ValueError("Batched transfers need content images of the same shape")
+            content = torch.cat(contents)
+            with torch.no_grad(), metrics.phase('content_features'):
+                content_features = self.get_features(content)
+            
+            # Stack each sample's (possibly cached) style gram matrices
+            grams = [self.get_style_grams(path) for path in style_paths]
+            style_grams = {layer: torch.stack([gram[layer] for gram in grams])
+                           for layer in self.style_weights}
+            
+            target = content.clone().requires_grad_(True).to(self.device)
+            opt = optim.Adam([target], lr=0.003)
+            
+            # One (b,) loss tensor per step, read back only when reported or checked
+            history = []
+            steps = [num_steps] * batch_size
+            final_losses = [None] * batch_size
+            results = [None] * batch_size
+            cancelled = set()
+            deadline_reached = set()
+            # As in optimize, a batch with a deadline keeps each sample's best image so far
+            if deadline is not None:
+                best_losses = torch.full((batch_size,), float('inf'), device=target.device)
+                best_targets = torch.empty_like(target.detach())
+            active = set(range(batch_size))
+            reporters = [self.make_reporter(num_steps, callback) for callback in progress_callbacks]
+            for ii in range(1, num_steps + 1):
+                for i in sorted(active):
+                    if should_stops[i] and should_stops[i]():
+                        steps[i] = ii - 1
+                        cancelled.add(i)
+                        active.discard(i)
+                if len(cancelled) == batch_size:
+                    raise TransferCancelled("Style transfer cancelled")
+                if not active:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    if history:
+                        # The last update has not been evaluated yet; one forward pass settles it
+                        with torch.no_grad():
+                            sample_losses = self.compute_loss(target, content_features, style_grams, per_sample=True)
+                        improved = sample_losses < best_losses
+                        best_losses = torch.where(improved, sample_losses, best_losses)
+                        best_targets[improved] = target.detach()[improved]
+                    for i in active:
+                        steps[i] = ii - 1
+                        if history:
+                            results[i] = best_targets[i:i + 1]
+                            final_losses[i] = float(best_losses[i])
+                        deadline_reached.add(i)
+                    break
+                started = time.perf_counter()
+                sample_losses = self.compute_loss(target, content_features, style_grams, per_sample=True)
+                forward_done = time.perf_counter()
+                
+                # Summing keeps each sample's gradient independent of the others
+                opt.zero_grad()
+                sample_losses.sum().backward()
+                backward_done = time.perf_counter()
+                if deadline is not None:
+                    improved = sample_losses.detach() < best_losses
+                    best_losses = torch.where(improved, sample_losses.detach(), best_losses)
+                    best_targets[improved] = target.detach()[improved]
+                opt.step()
+                target.data.clamp_(0, 1)
+                self.record_step(started, forward_done, backward_done)
+                
+                history.append(sample_losses.detach())
+                values = None
+                for i in sorted(active):
+                    if reporters[i].due(ii):
+                        values = values or history[-1].tolist()
+                        reporters[i].step(ii, values[i])
+                    if tolerance is not None and ii % self.convergence_check_every == 0 and self.has_converged(
+                            [step_losses[i] for step_losses in history[-window - 1:]], window, tolerance):
+                        results[i] = target[i:i + 1].detach().clone()
+                        steps[i] = ii
+                        final_losses[i] = float(history[-1][i])
+                        active.discard(i)
+                if not active:
+                    break
+            
+            outputs = []
+            for i in range(batch_size):
+                if results[i] is None and history:
+                    final_losses[i] = float(history[-1][i])
+                image = self.tensor_to_image(results[i] if results[i] is not None else target[i:i + 1])
+                info = {
+                    'optimizer': 'adam',
+                    'steps': steps[i] if history else 0,
+                    'max_steps': num_steps,
+                    'final_loss': final_losses[i],
+                    'stopped_early': steps[i] < num_steps,
+                    'batch_size': batch_size
+                }
+                if i in cancelled:
+                    info['cancelled'] = True
+                elif i in deadline_reached:
+                    info['deadline_reached'] = True
+                outputs.append((image, info))
+            
+            self.logger.info(f"Batched style transfer of {batch_size} images completed successfully")
+            return outputs
+            
+        except TransferCancelled:
+            self.logger.info("Batched style transfer cancelled")
+            raise
+        except Exception as e:
+            self.logger.error(f"Error during batched style transfer: {str(e)}")
+            raise
+
+    def working_shape(self, image_size, size=None):
+        """(h, w) a (width, height) image is resized to at the working resolution."""
+        size = size or self.image_size
+        width, height = image_size
+        if width <= height:
+            return int(size * height / width), size
+        return size, int(size * width / height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the VGG feature weights used by StyleTransferModel")
+    parser.add_argument('--output', default=os.path.join('weights', 'vgg19_features.pt'),
+                        help="Where to write the weights file (VGG_WEIGHTS_PATH)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    model = StyleTransferModel(weights_path=None, lazy=True)
+    model.save_vgg_weights(model.load().cpu(), args.output)
+    print(f"Saved {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, Optional, Union
+
+
+class Subscription:
+    """One subscriber's view of a channel, consumed from an asyncio event loop.
+
+    Messages published before the subscription (the channel's newest binary frame,
+    then its ring buffer) are replayed first. After that only the newest undelivered
+    message of each kind is kept, so a slow subscriber skips stale updates instead
+    of building up a backlog, and a preview frame never displaces a JSON update.
+    """
+
+    def __init__(self, channel_id: str, loop: asyncio.AbstractEventLoop, backlog: Iterable):
+        self.channel_id = channel_id
+        self.loop = loop
+        self.backlog = deque(backlog)
+        self.latest = {}
+        self.event = asyncio.Event()
+        if self.backlog:
+            self.event.set()
+
+    def offer(self, message):
+        """Called on the subscriber's loop with a newly published message."""
+        self.latest['frame' if isinstance(message, bytes) else 'message'] = message
+        self.event.set()
+
+    async def get(self):
+        """Wait for the next message to deliver, a dict or a binary frame."""
+        while True:
+            if self.backlog:
+                return self.backlog.popleft()
+            if self.latest:
+                return self.latest.pop(next(iter(self.latest)))
+            self.event.clear()
+            await self.event.wait()
+
+
+class Channel:
+    def __init__(self, history_size: int):
+        self.history = deque(maxlen=history_size)
+        self.frame = None
+        self.subscribers = set()
+        self.last_activity = time.monotonic()
+
+
+class ProgressHub:
+    """Thread-safe publish/subscribe hub for job progress.
+
+    Worker threads publish with publish(); worker processes can put
+    (channel_ids, message) tuples on a multiprocessing queue handed to listen().
+    Messages are JSON-serialisable dicts or binary frames (bytes). Each channel keeps
+    its last history_size dicts and its newest frame for reconnecting clients.
+    Channels without subscribers are dropped after idle_timeout seconds.
+    """
+
+    def __init__(self, history_size: int = 16, idle_timeout: float = 600):
+        self.logger = logging.getLogger(__name__)
+        self.history_size = history_size
+        self.idle_timeout = idle_timeout
+        self.channels: Dict[str, Channel] = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel_ids: Union[str, Iterable[str]], message: Union[dict, bytes]):
+        """Record a message on one or more channels and hand it to their subscribers."""
+        if isinstance(channel_ids, str):
+            channel_ids = [channel_ids]
+        with self.lock:
+            subscribers = []
+            for channel_id in channel_ids:
+                channel = self._channel(channel_id)
+                if isinstance(message, bytes):
+                    channel.frame = message
+                else:
+                    channel.history.append(message)
+                channel.last_activity = time.monotonic()
+                subscribers.extend(channel.subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+            except RuntimeError:
+                # The subscriber's loop has been closed
+                self.unsubscribe(subscription)
+
+    def subscribe(self, channel_id: str, loop: Optional[asyncio.AbstractEventLoop] = None) -> Subscription:
+        """Subscribe from a coroutine; the channel's recent messages are replayed first."""
+        loop = loop or asyncio.get_running_loop()
+        with self.lock:
+            channel = self._channel(channel_id)
+            backlog = [channel.frame] if channel.frame is not None else []
+            backlog.extend(channel.history)
+            subscription = Subscription(channel_id, loop, backlog)
+            channel.subscribers.add(subscription)
+            channel.last_activity = time.monotonic()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            channel = self.channels.get(subscription.channel_id)
+            if channel:
+                channel.subscribers.discard(subscription)
+                channel.last_activity = time.monotonic()
+
+    def latest(self, channel_id: str) -> Optional[dict]:
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            return channel.history[-1] if channel and channel.history else None
+
+    def subscriber_count(self, channel_id: Optional[str] = None) -> int:
+        with self.lock:
+            if channel_id is not None:
+                channel = self.channels.get(channel_id)
+                return len(channel.subscribers) if channel else 0
+            return sum(len(channel.subscribers) for channel in self.channels.values())
+
+    def cleanup(self) -> int:
+        """Drop channels that have had no subscribers and no messages for idle_timeout seconds."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [channel_id for channel_id, channel in self.channels.items()
+                    if not channel.subscribers and channel.last_activity < cutoff]
+            for channel_id in idle:
+                del self.channels[channel_id]
+        return len(idle)
+
+    def listen(self, queue):
+        """Forward (channel_ids, message) tuples from a multiprocessing queue; None stops it."""
+        def forward():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                self.publish(*item)
+        thread = threading.Thread(target=forward, name='progress-hub-listener', daemon=True)
+        thread.start()
+        return thread
+
+    def _channel(self, channel_id: str) -> Channel:
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = Channel(self.history_size)
+        return channel
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class ResultCache:
+    """Disk cache of finished transfers keyed by inputs and parameters.
+
+    Each entry is a result image plus a JSON sidecar with the optimisation info.
+    Entries are evicted least-recently-used first once the files on disk exceed
+    max_bytes. Access order survives restarts through file modification times.
+    """
+
+    def __init__(self, cache_dir: str = 'cache/results', max_bytes: int = 512 * 1024 * 1024):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[str, int]' = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(**params) -> str:
+        """Stable hash of the content/style hashes and every parameter that affects the output."""
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, dict]]:
+        """Return (image path, info) for a cached result, or None on a miss."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            image_path, info_path = self._paths(key)
+            try:
+                with open(info_path, 'r') as f:
+                    info = json.load(f)
+                os.utime(image_path)
+            except (OSError, json.JSONDecodeError):
+                self._evict(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return image_path, info
+
+    def put(self, key: str, image_path: str, info: dict):
+        """Copy a finished result into the cache and evict old entries beyond the budget."""
+        cached_image, info_path = self._paths(key)
+        try:
+            tmp_path = f'{cached_image}.{threading.get_ident()}.tmp'
+            shutil.copyfile(image_path, tmp_path)
+            os.replace(tmp_path, cached_image)
+            with open(info_path, 'w') as f:
+                json.dump(info, f)
+        except OSError as e:
+            self.logger.error(f"Error caching result {key[:12]}: {str(e)}")
+            return
+        size = os.path.getsize(cached_image) + os.path.getsize(info_path)
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries[key]
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self.entries:
+                self._evict(next(iter(self.entries)))
+
+    def materialize(self, cached_path: str, output_path: str):
+        """Place a cached result at output_path, hard-linking when possible."""
+        try:
+            os.link(cached_path, output_path)
+        except OSError:
+            shutil.copyfile(cached_path, output_path)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return os.path.join(self.cache_dir, f'{key}.jpg'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def _load_index(self):
+        """Rebuild the LRU order from the files already on disk."""
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.jpg'):
+                continue
+            key = name[:-len('.jpg')]
+            image_path, info_path = self._paths(key)
+            if not os.path.exists(info_path):
+                continue
+            found.append((os.path.getmtime(image_path), key,
+                          os.path.getsize(image_path) + os.path.getsize(info_path)))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self.entries:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key: str):
+        self.current_bytes -= self.entries.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
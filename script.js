@@ -866,11 +866,41 @@ async function transferStyle(contentFile, styleFile) {
 
         // Connect to WebSocket for progress updates
         const ws = new WebSocket(`ws://127.0.0.1:5000/ws/${clientId}`);
+        ws.binaryType = 'blob';
         
         ws.onmessage = function(event) {
+            if (event.data instanceof Blob) {
+                // Live preview frame of the image being optimised
+                const resultImage = document.getElementById('resultImage');
+                if (resultImage) {
+                    if (resultImage.src.startsWith('blob:')) {
+                        URL.revokeObjectURL(resultImage.src);
+                    }
+                    resultImage.src = URL.createObjectURL(event.data);
+                    resultImage.style.display = 'block';
+                }
+                return;
+            }
+
             const data = JSON.parse(event.data);
-            
-            if (data.completed) {
+
+            if (data.cancelled) {
+                // The job was cancelled on the server before it finished
+                if (loadingOverlay) {
+                    loadingOverlay.style.display = 'none';
+                }
+                transformBtn.innerHTML = originalButtonText;
+                transformBtn.disabled = false;
+                showError('The transformation was cancelled.');
+            } else if (data.failed) {
+                // The background job failed on the server
+                if (loadingOverlay) {
+                    loadingOverlay.style.display = 'none';
+                }
+                transformBtn.innerHTML = originalButtonText;
+                transformBtn.disabled = false;
+                showError('Failed to transform image. Please try again.');
+            } else if (data.completed) {
                 // Hide loading overlay
                 if (loadingOverlay) {
                     loadingOverlay.style.display = 'none';
@@ -909,6 +939,7 @@ async function transferStyle(contentFile, styleFile) {
         formData.append('style', styleFile);
         formData.append('email', userEmail);
         formData.append('client_id', clientId);
+        formData.append('preview', 'true');
 
         // Send request to backend
         const response = await fetch('http://127.0.0.1:5000/api/transfer', {
@@ -996,7 +1027,10 @@ async function loadGallery() {
         const apiUrl = `http://127.0.0.1:5000/api/gallery/${encodeURIComponent(userEmail)}?page=${currentPage}&per_page=20`;
         console.log('Fetching gallery from:', apiUrl);
 
-        const response = await fetch(apiUrl);
+        // List the image formats we can display so thumbnails can use the smaller ones
+        const response = await fetch(apiUrl, {
+            headers: { 'Accept': 'application/json, image/avif, image/webp' }
+        });
         if (!response.ok) {
             const errorData = await response.json();
             console.error('Gallery API error:', errorData);
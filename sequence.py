@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from model import StyleTransferModel
+from style_cache import StyleFeatureCache
+
+FRAME_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.gif')
+
+
+def list_frames(directory):
+    """Image files in a directory, in name order."""
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.lower().endswith(FRAME_EXTENSIONS)]
+
+
+def run_ffmpeg(args):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg is required for video input and output; pass a directory of frames instead")
+    subprocess.run([ffmpeg, '-loglevel', 'error', '-y', *args], check=True)
+
+
+def extract_frames(video_path, output_dir, fps=None):
+    """Split a video into numbered PNG frames with ffmpeg and return their paths."""
+    os.makedirs(output_dir, exist_ok=True)
+    args = ['-i', video_path]
+    if fps:
+        args += ['-vf', f'fps={fps}']
+    run_ffmpeg(args + [os.path.join(output_dir, 'frame_%06d.png')])
+    return list_frames(output_dir)
+
+
+def assemble_video(frame_pattern, output_path, fps):
+    """Encode numbered frames back into a video with ffmpeg."""
+    run_ffmpeg(['-framerate', str(fps), '-i', frame_pattern, '-pix_fmt', 'yuv420p', output_path])
+
+
+class FramePipeline:
+    """Stylize a sequence of frame files as a stream.
+
+    A reader thread decodes up to prefetch frames ahead of the optimiser and a writer
+    thread encodes finished frames behind it, so file I/O overlaps the optimisation
+    instead of adding to it. Frames go through StyleTransferModel.transfer_style_sequence.
+    """
+
+    def __init__(self, model, prefetch=4):
+        self.logger = logging.getLogger(__name__)
+        self.model = model
+        self.prefetch = prefetch
+
+    def read_frames(self, paths, frames):
+        """Reader thread: decode frames in order; None marks the end."""
+        try:
+            for path in paths:
+                with Image.open(path) as img:
+                    frames.put(img.convert('RGB'))
+        except Exception as e:
+            self.logger.error(f"Error reading frames: {str(e)}")
+            frames.put(e)
+        frames.put(None)
+
+    def write_frames(self, results, errors):
+        """Writer thread: encode (image, path) pairs until None arrives."""
+        while True:
+            item = results.get()
+            if item is None:
+                return
+            image, path = item
+            try:
+                image.save(path)
+            except Exception as e:
+                self.logger.error(f"Error writing {path}: {str(e)}")
+                errors.append(e)
+
+    def run(self, paths, style_path, output_dir, progress_callback=None, **options):
+        """Stylize paths into output_dir (same file names, PNG) and return a summary.
+
+        options are passed to transfer_style_sequence. progress_callback(current, total, info)
+        is called after each frame.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        frames = queue.Queue(maxsize=self.prefetch)
+        results = queue.Queue(maxsize=self.prefetch)
+        errors = []
+        reader = threading.Thread(target=self.read_frames, args=(paths, frames), name='frame-reader', daemon=True)
+        writer = threading.Thread(target=self.write_frames, args=(results, errors), name='frame-writer', daemon=True)
+        reader.start()
+        writer.start()
+
+        def decoded():
+            while True:
+                frame = frames.get()
+                if isinstance(frame, Exception):
+                    raise frame
+                if frame is None:
+                    return
+                yield frame
+
+        infos = []
+        previous = None
+        differences = []
+        started = time.perf_counter()
+        try:
+            for image, info in self.model.transfer_style_sequence(decoded(), style_path, **options):
+                index = info['frame']
+                name = os.path.splitext(os.path.basename(paths[index]))[0] + '.png'
+                results.put((image, os.path.join(output_dir, name)))
+
+                # Mean absolute change from the previous stylized frame, a simple flicker measure
+                pixels = np.asarray(image, dtype=np.float32)
+                if previous is not None and previous.shape == pixels.shape:
+                    differences.append(float(np.abs(pixels - previous).mean()))
+                previous = pixels
+
+                infos.append(info)
+                self.logger.info(f"Frame {index + 1}/{len(paths)}: {info['steps']} steps")
+                if progress_callback:
+                    progress_callback(index + 1, len(paths), info)
+        finally:
+            results.put(None)
+            writer.join()
+        seconds = time.perf_counter() - started
+        if errors:
+            raise errors[0]
+
+        later = [info['steps'] for info in infos[1:]]
+        return {
+            'frames': len(infos),
+            'seconds': seconds,
+            'frames_per_second': len(infos) / seconds if seconds else 0.0,
+            'first_frame_steps': infos[0]['steps'] if infos else 0,
+            'mean_frame_steps': sum(later) / len(later) if later else None,
+            'total_steps': sum(info['steps'] for info in infos),
+            'mean_frame_difference': sum(differences) / len(differences) if differences else None,
+            'frames_info': infos
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stylize an image sequence or a video, warm-starting each frame")
+    parser.add_argument('--input', required=True, help="directory of frames, or a video file (needs ffmpeg)")
+    parser.add_argument('--style', required=True, help="style image")
+    parser.add_argument('--output', required=True, help="output directory, or a video file (needs ffmpeg)")
+    parser.add_argument('--fps', type=float, default=None,
+                        help="frame rate to extract and encode videos at (default: the source rate, 24 for output)")
+    parser.add_argument('--size', type=int, default=None, help="working resolution, shorter edge in pixels")
+    parser.add_argument('--steps', type=int, default=500, help="steps for the first frame")
+    parser.add_argument('--frame-steps', type=int, default=None,
+                        help="step ceiling for warm-started frames (default: a tenth of --steps)")
+    parser.add_argument('--optimizer', default='adam', choices=StyleTransferModel.OPTIMIZERS)
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help="stop a frame early once the relative loss improvement drops below this")
+    parser.add_argument('--window', type=int, default=10, help="steps over which --tolerance is measured")
+    parser.add_argument('--cold', action='store_true',
+                        help="run every frame from scratch with --steps, for comparison")
+    parser.add_argument('--prefetch', type=int, default=4, help="frames decoded ahead and encoded behind")
+    parser.add_argument('--weights', default=os.path.join('weights', 'vgg19_features.pt'))
+    parser.add_argument('--summary', help="write the run summary as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    # The per-step progress and per-image logs are too chatty for a frame loop
+    logging.getLogger('model').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if os.path.isdir(args.input):
+            paths = list_frames(args.input)
+        else:
+            paths = extract_frames(args.input, os.path.join(work_dir, 'input'), args.fps)
+        if not paths:
+            parser.error(f"No frames found in {args.input}")
+
+        to_video = args.output.lower().endswith(VIDEO_EXTENSIONS)
+        output_dir = os.path.join(work_dir, 'output') if to_video else args.output
+
+        model = StyleTransferModel(style_cache=StyleFeatureCache(), weights_path=args.weights)
+        summary = FramePipeline(model, prefetch=args.prefetch).run(
+            paths, args.style, output_dir, num_steps=args.steps, frame_steps=args.frame_steps,
+            optimizer=args.optimizer, tolerance=args.tolerance, window=args.window, size=args.size,
+            warm_start=not args.cold)
+
+        if to_video:
+            # ffmpeg wants a numbered sequence, so link the frames under sequential names
+            frames_dir = os.path.join(work_dir, 'numbered')
+            os.makedirs(frames_dir)
+            for index, path in enumerate(paths):
+                name = os.path.splitext(os.path.basename(path))[0] + '.png'
+                os.link(os.path.join(output_dir, name), os.path.join(frames_dir, f'frame_{index:06d}.png'))
+            assemble_video(os.path.join(frames_dir, 'frame_%06d.png'), args.output, args.fps or 24)
+
+    print(f"{summary['frames']} frames in {summary['seconds']:.1f}s ({summary['frames_per_second']:.2f} frames/s), "
+          f"first frame {summary['first_frame_steps']} steps, later frames {summary['mean_frame_steps'] or 0:.1f} "
+          f"steps on average, mean frame difference {summary['mean_frame_difference'] or 0:.2f}")
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
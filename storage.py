@@ -0,0 +1,342 @@
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import metrics
+
+
+class UserStore:
+    """SQLite-backed store for users and their transformed images.
+
+    Runs in WAL mode so readers never block the writer, keeps one connection per
+    thread, and indexes images by (email, transformed_at, id) and (email, filename)
+    so per-user lookups do not scan everybody's history.
+
+    Each user row also carries a gallery version, modification time and image
+    count that are bumped in the same transaction as any image change. Versions
+    are mirrored in memory so conditional gallery requests can be answered
+    without a query while the database is unchanged.
+    """
+
+    USER_FIELDS = ('name', 'uid', 'is_verified', 'created_at', 'last_login')
+
+    def __init__(self, db_path: str = 'users.db', legacy_json_path: Optional[str] = 'users.json'):
+        self.logger = logging.getLogger(__name__)
+        self.db_path = db_path
+        self.local = threading.local()
+        self.gallery_versions = {}
+        self.versions_lock = threading.Lock()
+        self._create_schema()
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self.local.conn = conn
+        return conn
+
+    def transaction(self):
+        """Context manager for an immediate (write-locked) transaction."""
+        return _Transaction(self.conn)
+
+    def _create_schema(self):
+        with self.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    email TEXT PRIMARY KEY,
+                    name TEXT,
+                    uid TEXT,
+                    is_verified INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT,
+                    last_login TEXT
+                )''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email TEXT NOT NULL REFERENCES users(email) ON DELETE CASCADE,
+                    filename TEXT,
+                    transformed_at TEXT NOT NULL DEFAULT '',
+                    data TEXT NOT NULL
+                )''')
+            conn.execute('DROP INDEX IF EXISTS idx_images_email_time')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_images_gallery ON images(email, transformed_at, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_images_email_filename ON images(email, filename)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    original_filename TEXT,
+                    size INTEGER NOT NULL,
+                    uploaded_at TEXT NOT NULL
+                )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_email ON uploads(email, uploaded_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads(sha256)')
+
+            # Gallery bookkeeping columns, added to databases created before them
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(users)')}
+            if 'gallery_version' not in columns:
+                conn.execute('ALTER TABLE users ADD COLUMN gallery_version INTEGER NOT NULL DEFAULT 0')
+                conn.execute('ALTER TABLE users ADD COLUMN gallery_updated_at TEXT')
+                conn.execute('ALTER TABLE users ADD COLUMN image_count INTEGER NOT NULL DEFAULT 0')
+                conn.execute('UPDATE users SET image_count = (SELECT COUNT(*) FROM images WHERE images.email = users.email)')
+
+    def migrate_from_json(self, json_path: str):
+        """Import users.json (load_users or TinyDB layout) once into the database."""
+        if not os.path.exists(json_path):
+            return
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+                return
+            try:
+                with open(json_path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                self.logger.error(f"Could not read {json_path} for migration: {str(e)}")
+                data = {}
+
+            users = list(data.get('users', []))
+            # TinyDB keeps documents under a table name keyed by document id
+            tinydb_table = data.get('_default', {})
+            if isinstance(tinydb_table, dict):
+                users.extend(tinydb_table.values())
+
+            migrated = 0
+            for user in users:
+                if not user.get('email'):
+                    continue
+                self._insert_user(conn, user)
+                images = user.get('transformed_images', []) + user.get('images', [])
+                for image in images:
+                    self._insert_image(conn, user['email'], image)
+                self._touch_gallery(conn, user['email'], len(images))
+                migrated += 1
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                         (datetime.now().isoformat(),))
+        self.logger.info(f"Migrated {migrated} user(s) from {json_path}")
+
+    # Users
+
+    def get_user(self, email: str) -> Optional[dict]:
+        row = self.conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        return self._user_from_row(row) if row else None
+
+    def user_exists(self, email: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone() is not None
+
+    def create_user(self, user: dict) -> bool:
+        """Insert a new user; returns False when the email is already registered."""
+        with self.transaction() as conn:
+            return self._insert_user(conn, user)
+
+    def update_user(self, email: str, fields: dict) -> bool:
+        """Update the given user columns; returns False when the user does not exist."""
+        fields = {key: value for key, value in fields.items() if key in self.USER_FIELDS}
+        if not fields:
+            return self.user_exists(email)
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        with self.transaction() as conn:
+            cursor = conn.execute(f'UPDATE users SET {assignments} WHERE email = ?',
+                                  (*self._user_values(fields), email))
+            return cursor.rowcount > 0
+
+    def upsert_user(self, user: dict):
+        with self.transaction() as conn:
+            if not self._insert_user(conn, user):
+                fields = {key: value for key, value in user.items() if key in self.USER_FIELDS}
+                assignments = ', '.join(f'{key} = ?' for key in fields)
+                conn.execute(f'UPDATE users SET {assignments} WHERE email = ?',
+                             (*self._user_values(fields), user['email']))
+
+    # Images
+
+    def add_image(self, email: str, record: dict) -> bool:
+        """Append an image record to a user's history; returns False for unknown users."""
+        with self.transaction() as conn:
+            if not conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone():
+                return False
+            self._insert_image(conn, email, record)
+            version = self._touch_gallery(conn, email, 1)
+        self._remember_version(email, version)
+        return True
+
+    def get_image(self, email: str, filename: str) -> Optional[dict]:
+        row = self.conn.execute('SELECT data FROM images WHERE email = ? AND filename = ? LIMIT 1',
+                                (email, filename)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def list_images(self, email: str, limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        """A user's images, newest first."""
+        query = 'SELECT data FROM images WHERE email = ? ORDER BY transformed_at DESC, id DESC'
+        params: tuple = (email,)
+        if limit is not None:
+            query += ' LIMIT ? OFFSET ?'
+            params += (limit, offset)
+        return [json.loads(row['data']) for row in self.conn.execute(query, params)]
+
+    def page_images(self, email: str, limit: int, cursor: Optional[str] = None,
+                    offset: int = 0) -> Tuple[List[dict], Optional[str]]:
+        """One gallery page, newest first, and the cursor of the next page (None on the last).
+
+        With a cursor the page is found by seeking the (email, transformed_at, id)
+        index, so deep pages cost the same as the first one; otherwise offset is used.
+        """
+        query = 'SELECT id, transformed_at, data FROM images WHERE email = ?'
+        params: tuple = (email,)
+        if cursor:
+            transformed_at, image_id = self.decode_cursor(cursor)
+            query += ' AND (transformed_at < ? OR (transformed_at = ? AND id < ?))'
+            params += (transformed_at, transformed_at, image_id)
+            offset = 0
+        query += ' ORDER BY transformed_at DESC, id DESC LIMIT ? OFFSET ?'
+        params += (limit + 1, max(offset, 0))
+        rows = self.conn.execute(query, params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1]['transformed_at'], rows[-1]['id'])
+        return [json.loads(row['data']) for row in rows], next_cursor
+
+    @staticmethod
+    def encode_cursor(transformed_at: str, image_id: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps([transformed_at, image_id]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, int]:
+        """Inverse of encode_cursor; raises ValueError for malformed cursors."""
+        try:
+            transformed_at, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return str(transformed_at), int(image_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    def count_images(self, email: str) -> int:
+        row = self.conn.execute('SELECT image_count FROM users WHERE email = ?', (email,)).fetchone()
+        return row['image_count'] if row else 0
+
+    def gallery_version(self, email: str) -> Optional[Tuple[int, Optional[str]]]:
+        """(version, last modified ISO time) of a user's gallery, or None for unknown users."""
+        # data_version only changes when another connection has committed
+        data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        with self.versions_lock:
+            if data_version != getattr(self.local, 'data_version', None):
+                self.local.data_version = data_version
+                self.gallery_versions.clear()
+            version = self.gallery_versions.get(email)
+        if version is not None:
+            return version
+
+        row = self.conn.execute('SELECT gallery_version, gallery_updated_at FROM users WHERE email = ?',
+                                (email,)).fetchone()
+        if not row:
+            return None
+        version = (row['gallery_version'], row['gallery_updated_at'])
+        self._remember_version(email, version)
+        return version
+
+    def delete_image(self, email: str, filename: str) -> bool:
+        with self.transaction() as conn:
+            cursor = conn.execute('DELETE FROM images WHERE email = ? AND filename = ?', (email, filename))
+            if cursor.rowcount == 0:
+                return False
+            version = self._touch_gallery(conn, email, -cursor.rowcount)
+        self._remember_version(email, version)
+        return True
+
+    def update_image(self, email: str, filename: str, fields: dict) -> Optional[dict]:
+        """Merge fields into an image record and return the updated record."""
+        with self.transaction() as conn:
+            row = conn.execute('SELECT id, data FROM images WHERE email = ? AND filename = ? LIMIT 1',
+                               (email, filename)).fetchone()
+            if not row:
+                return None
+            record = {**json.loads(row['data']), **fields}
+            conn.execute('UPDATE images SET data = ? WHERE id = ?', (json.dumps(record), row['id']))
+            version = self._touch_gallery(conn, email, 0)
+        self._remember_version(email, version)
+        return record
+
+    # Uploads
+
+    def add_upload(self, email: str, sha256: str, kind: str, original_filename: str, size: int):
+        """Record that a user uploaded the blob with this hash."""
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO uploads (email, sha256, kind, original_filename, size, uploaded_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (email, sha256, kind, original_filename, size, datetime.now().isoformat()))
+
+    def upload_ref_count(self, sha256: str) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM uploads WHERE sha256 = ?', (sha256,)).fetchone()[0]
+
+    # Helpers
+
+    def _insert_user(self, conn, user: dict) -> bool:
+        cursor = conn.execute(
+            f'INSERT OR IGNORE INTO users (email, {", ".join(self.USER_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?)',
+            (user['email'], *self._user_values({key: user.get(key) for key in self.USER_FIELDS})))
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _user_values(fields: dict) -> tuple:
+        return tuple(int(bool(value)) if key == 'is_verified' else value for key, value in fields.items())
+
+    @staticmethod
+    def _touch_gallery(conn, email: str, count_delta: int) -> Tuple[int, str]:
+        """Bump a user's gallery version inside the current transaction."""
+        updated_at = datetime.now(timezone.utc).isoformat()
+        conn.execute('UPDATE users SET gallery_version = gallery_version + 1, gallery_updated_at = ?, '
+                     'image_count = image_count + ? WHERE email = ?', (updated_at, count_delta, email))
+        row = conn.execute('SELECT gallery_version FROM users WHERE email = ?', (email,)).fetchone()
+        return row['gallery_version'], updated_at
+
+    def _remember_version(self, email: str, version: Tuple[int, str]):
+        # Concurrent writers may finish out of order; never go back to an older version
+        with self.versions_lock:
+            current = self.gallery_versions.get(email)
+            if current is None or version[0] >= current[0]:
+                self.gallery_versions[email] = version
+
+    @staticmethod
+    def _insert_image(conn, email: str, record: dict):
+        conn.execute('INSERT INTO images (email, filename, transformed_at, data) VALUES (?, ?, ?, ?)',
+                     (email, record.get('filename'),
+                      record.get('transformed_at', record.get('timestamp', '')), json.dumps(record)))
+
+    @classmethod
+    def _user_from_row(cls, row) -> dict:
+        user = {key: row[key] for key in ('email',) + cls.USER_FIELDS}
+        user['is_verified'] = bool(user['is_verified'])
+        return user
+
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.started = None
+
+    def __enter__(self):
+        # Timed from BEGIN so waiting on the write lock counts towards store_write
+        self.started = time.perf_counter()
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        metrics.observe_phase('store_write', time.perf_counter() - self.started)
+        return False
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import torch
+
+
+class StyleFeatureCache:
+    """Two-tier cache of style Gram matrices.
+
+    The memory tier is an LRU bounded by a byte budget. The disk tier stores one
+    .pt file per key under cache_dir so precomputed styles survive restarts; it is
+    an LRU of its own bounded by max_disk_bytes, ordered across restarts by file
+    modification times.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = 'cache/style_grams', max_bytes: int = 256 * 1024 * 1024,
+                 max_disk_bytes: int = 1024 * 1024 * 1024):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries: 'OrderedDict[str, Dict[str, torch.Tensor]]' = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.current_bytes = 0
+        self.disk_entries: 'OrderedDict[str, int]' = OrderedDict()
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_disk_index()
+
+    # Bumped whenever the features behind cached Grams change, so old entries are not reused
+    KEY_VERSION = 2
+
+    @staticmethod
+    def make_key(image, resolution) -> str:
+        """Hash the decoded RGB pixels of a PIL image together with the working resolution."""
+        digest = hashlib.sha256()
+        digest.update(f"v{StyleFeatureCache.KEY_VERSION}:{image.mode}:{image.size}:{resolution}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str, device=None) -> Optional[Dict[str, torch.Tensor]]:
+        """Return the cached Grams for key, promoting disk entries into memory."""
+        with self.lock:
+            grams = self.entries.get(key)
+            if grams is not None:
+                self.entries.move_to_end(key)
+                # Styles hot in memory stay recent on disk too, for the next restart
+                if key in self.disk_entries:
+                    self.disk_entries.move_to_end(key)
+                self.hits += 1
+                return grams
+
+        grams = self._load_from_disk(key, device)
+        with self.lock:
+            if grams is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, grams)
+        return grams
+
+    def put(self, key: str, grams: Dict[str, torch.Tensor]):
+        """Add Grams to both tiers."""
+        grams = {layer: gram.detach() for layer, gram in grams.items()}
+        with self.lock:
+            self._store(key, grams)
+        self._save_to_disk(key, grams)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
+
+    def _store(self, key: str, grams: Dict[str, torch.Tensor]):
+        size = sum(gram.element_size() * gram.nelement() for gram in grams.values())
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.sizes[key]
+        self.entries[key] = grams
+        self.entries.move_to_end(key)
+        self.sizes[key] = size
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            evicted, _ = self.entries.popitem(last=False)
+            self.current_bytes -= self.sizes.pop(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.pt')
+
+    def _load_disk_index(self):
+        """Rebuild the disk LRU order from the files already in cache_dir."""
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pt'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            found.append((os.path.getmtime(path), name[:-len('.pt')], os.path.getsize(path)))
+        with self.lock:
+            for _, key, size in sorted(found):
+                self.disk_entries[key] = size
+                self.disk_bytes += size
+            self._trim_disk()
+
+    def _trim_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk_entries:
+            self._evict_from_disk(next(iter(self.disk_entries)))
+
+    def _evict_from_disk(self, key: str):
+        self.disk_bytes -= self.disk_entries.pop(key, 0)
+        try:
+            os.remove(self._disk_path(key))
+        except FileNotFoundError:
+            # Another process sharing cache_dir may have evicted it already
+            pass
+
+    def _load_from_disk(self, key: str, device=None) -> Optional[Dict[str, torch.Tensor]]:
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            grams = torch.load(path, map_location=device, weights_only=True)
+            os.utime(path)
+        except Exception as e:
+            self.logger.warning(f"Discarding unreadable style cache entry {path}: {str(e)}")
+            return None
+        with self.lock:
+            if key not in self.disk_entries:
+                # Written by another process sharing cache_dir
+                self.disk_entries[key] = os.path.getsize(path)
+                self.disk_bytes += self.disk_entries[key]
+            self.disk_entries.move_to_end(key)
+            self._trim_disk()
+        return grams
+
+    def _save_to_disk(self, key: str, grams: Dict[str, torch.Tensor]):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            torch.save({layer: gram.cpu() for layer, gram in grams.items()}, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.logger.error(f"Error writing style cache entry {path}: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        size = os.path.getsize(path)
+        with self.lock:
+            self.disk_bytes += size - self.disk_entries.get(key, 0)
+            self.disk_entries[key] = size
+            self.disk_entries.move_to_end(key)
+            self._trim_disk()
@@ -0,0 +1,62 @@
+import hashlib
+import logging
+import os
+import uuid
+from typing import BinaryIO, Tuple
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the configured byte cap."""
+
+
+class BlobStore:
+    """Content-addressed storage for uploaded images.
+
+    Files live at <root>/<sha[:2]>/<sha256>, so uploading the same bytes again
+    reuses the existing blob instead of writing another copy.
+    """
+
+    def __init__(self, root: str = os.path.join('uploads', 'blobs'), chunk_size: int = 1024 * 1024):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def store_stream(self, stream: BinaryIO, max_bytes: int) -> Tuple[str, str, int, bool]:
+        """Hash a seekable stream chunk by chunk and store it unless the blob already exists.
+
+        Returns (sha256, path, size, written). Raises UploadTooLarge as soon as more
+        than max_bytes have been read, before anything is written. Bytes that are
+        already stored are only read, never written again.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        stream.seek(0)
+        for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Upload exceeds the {max_bytes} byte limit")
+            digest.update(chunk)
+
+        sha256 = digest.hexdigest()
+        path = self.path_for(sha256)
+        if os.path.exists(path):
+            self.logger.info(f"Upload {sha256[:12]} already stored, skipping write")
+            return sha256, path, size, False
+
+        # Copied from the spooled upload under a temporary name, so a partial blob is never visible
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            stream.seek(0)
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return sha256, path, size, True